@@ -1,5 +1,5 @@
 /*  This sketch sends a message to a TCP server
- *
+ *  The connection is kept open and reused for every reading
  */
 
 #include <WiFi.h>
@@ -14,6 +14,14 @@ const char* password = "passpasspass";
 const char* host = "192.168.1.77";
 const uint16_t port = 5050;
 
+// 1 -> compact binary frames (see framing.py), 0 -> ascii "   6001,23" frames
+#define USE_BINARY_PROTOCOL 0
+const uint32_t sensor_id = 1;
+
+// Use WiFiClient class to create TCP connections
+// kept across loop() calls so every reading reuses the same connection
+WiFiClient client;
+
 
 void setup()
 {
@@ -41,27 +49,75 @@ void setup()
 }
 
 
-void loop()
+// writes v in network byte order
+void putU32(uint8_t* buf, uint32_t v)
 {
-    Serial.print("Connecting to ");
-    Serial.println(host);
+    buf[0] = v >> 24;
+    buf[1] = v >> 16;
+    buf[2] = v >> 8;
+    buf[3] = v;
+}
 
-    // Use WiFiClient class to create TCP connections
-    WiFiClient client;
+// binary HELLO: offer protocol version 1, the server answers with the version to use
+bool negotiateBinary()
+{
+    uint8_t hello[7] = {0xE5, 1, 0, 0, 0, 0, 0}; // magic, version, HELLO, length 0
+    client.write(hello, sizeof(hello));
 
-    if (!client.connect(host, port)) {
-        Serial.println("Connection failed.");
-        Serial.println("Waiting 5 seconds before retrying...");
-        delay(5000);
-        return;
+    uint8_t reply[7];
+    if (client.readBytes(reply, sizeof(reply)) != sizeof(reply) || reply[0] != 0xE5) {
+        return false;
     }
-  
+    Serial.print("Binary protocol version ");
+    Serial.println(reply[1]);
+    return true;
+}
+
+// binary READING frame: header + sensor id, timestamp (0: server time), float value
+void sendBinaryReading(uint32_t id, float value)
+{
+    uint8_t frame[7 + 12] = {0xE5, 1, 1}; // magic, version, READING
+    uint32_t bits;
+    memcpy(&bits, &value, sizeof(bits));
+
+    putU32(frame + 3, 12);
+    putU32(frame + 7, id);
+    putU32(frame + 11, 0);
+    putU32(frame + 15, bits);
+    client.write(frame, sizeof(frame));
+}
+
+
+void loop()
+{
+    if (!client.connected()) {
+        Serial.print("Connecting to ");
+        Serial.println(host);
+
+        if (!client.connect(host, port)) {
+            Serial.println("Connection failed.");
+            Serial.println("Waiting 5 seconds before retrying...");
+            delay(5000);
+            return;
+        }
+#if USE_BINARY_PROTOCOL
+        if (!negotiateBinary()) {
+            Serial.println("Protocol negotiation failed.");
+            client.stop();
+            delay(5000);
+            return;
+        }
+#endif
+    }
+
+#if USE_BINARY_PROTOCOL
+    sendBinaryReading(sensor_id, 23.0);
+#else
     client.print("   6"); // message length as a 4 byte str
     client.print("001,23");
+#endif
     Serial.println("Sent msg to server");
-    Serial.println("Closing connection.");
-    client.stop();
 
-    Serial.println("Waiting 5 seconds before restarting...");
+    Serial.println("Waiting 5 seconds before sending again...");
     delay(5000);
 }
@@ -12,10 +12,27 @@ from PyQt5.QtWidgets import (
     QGridLayout,
     QLineEdit,
     QVBoxLayout,
+    QScrollArea,
+    QTableView,
+    QHeaderView,
+)
+from PyQt5.QtCore import (
+    Qt,
+    QObject,
+    pyqtSignal,
+    QRunnable,
+    pyqtSlot,
+    QThreadPool,
+    QTimer,
+    QAbstractTableModel,
+    QModelIndex,
 )
-from PyQt5.QtCore import Qt, QObject, pyqtSignal, QRunnable, pyqtSlot, QThreadPool
 import sys
+import bisect
+import threading
 from server import ESPLServer
+from console_log import setup_console_log
+from readings import sensor_name, format_value
 import socket
 
 
@@ -48,6 +65,29 @@ class Worker(QRunnable):
         result = self.fn(*self.args, **self.kwargs)
 
 
+class CoalescedUpdates:
+    """
+    stands in for the progress signal of the logger thread
+    keeps only the latest reading of every sensor, the GUI thread collects
+    them on a timer instead of handling one queued signal per message
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def emit(self, reading):
+        """called from the logger thread"""
+        with self.lock:
+            self.pending[reading.sensor_id] = reading
+
+    def take(self):
+        """called from the GUI thread, returns {sensor_id: latest Reading}"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+
 class BoxWidget:
     def __init__(self, id_text, width=90, height=70):
         self.widget = QWidget()
@@ -86,49 +126,139 @@ class BoxWidget:
 
 
 class DisplayGrid:
-    def __init__(self):
-        self.widget = QWidget()
+    """
+    one BoxWidget per sensor, boxes are created as new sensor ids show up
+    fine for a few dozen sensors, use SensorTable for larger fleets
+    """
+
+    def __init__(self, COLUMNS=4):
+        self.COLUMNS = COLUMNS
 
-        """Create the boxes"""
+        """Create the (empty) grid"""
         self.boxes = {}
-        boxesLayout = QGridLayout()
-        # Button text | position on the QGridLayout
-        _boxes = {
-            "001": (0, 0),
-            "002": (0, 1),
-            "003": (0, 2),
-            "004": (0, 3),
-            "005": (1, 0),
-            "006": (1, 1),
-            "007": (1, 2),
-            "008": (1, 3),
-        }
-        # Create the buttons and add them to the grid layout
-        for _id, pos in _boxes.items():
-            self.boxes[_id] = BoxWidget(_id)
-            boxesLayout.addWidget(self.boxes[_id].widget, pos[0], pos[1])
-
-        # Add boxesLayout to the the widget
-        self.widget.setLayout(boxesLayout)
+        self.boxesLayout = QGridLayout()
+        self.boxesLayout.setAlignment(Qt.AlignTop)
+        boxesWidget = QWidget()
+        boxesWidget.setLayout(self.boxesLayout)
+
+        # scroll once the boxes no longer fit in the window
+        self.widget = QScrollArea()
+        self.widget.setWidgetResizable(True)
+        self.widget.setWidget(boxesWidget)
+
+    def addBox(self, box_id):
+        """Create the box of a new sensor at the next free grid position."""
+        row, col = divmod(len(self.boxes), self.COLUMNS)
+        self.boxes[box_id] = BoxWidget(box_id)
+        self.boxesLayout.addWidget(self.boxes[box_id].widget, row, col)
 
     def setBoxText(self, msg):
         """Set display's text."""
         box_id, text = msg
+        if box_id not in self.boxes:
+            self.addBox(box_id)
         self.boxes[box_id].display.setText(text)
         # self.display.setFocus()  # ?
 
-    def clearBoxText(self):
+    def clearBoxText(self, box_id):
+        """Clear the display."""
+        self.setBoxText((box_id, ""))
+
+
+class SensorTableModel(QAbstractTableModel):
+    """
+    ID | TEMP table of the latest reading of every sensor, sorted by ID
+    """
+
+    HEADERS = ("ID", "TEMP")
+
+    def __init__(self):
+        super().__init__()
+        self.ids = []  # sorted sensor ids, one per row
+        self.values = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.ids)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.TextAlignmentRole):
+            return None
+        if role == Qt.TextAlignmentRole:
+            return Qt.AlignCenter
+        box_id = self.ids[index.row()]
+        return box_id if index.column() == 0 else self.values[box_id]
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+    def setReading(self, box_id, text):
+        """Update (or insert) the row of box_id."""
+        row = bisect.bisect_left(self.ids, box_id)
+        if row < len(self.ids) and self.ids[row] == box_id:
+            self.values[box_id] = text
+            index = self.index(row, 1)
+            self.dataChanged.emit(index, index)
+        else:
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.ids.insert(row, box_id)
+            self.values[box_id] = text
+            self.endInsertRows()
+
+
+class SensorTable:
+    """
+    model/view alternative to DisplayGrid for hundreds of sensors,
+    the view only renders the visible rows
+    """
+
+    def __init__(self):
+        self.model = SensorTableModel()
+        self.widget = QTableView()
+        self.widget.setModel(self.model)
+        self.widget.verticalHeader().setVisible(False)
+        self.widget.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+
+    def setBoxText(self, msg):
+        """Set display's text."""
+        box_id, text = msg
+        self.model.setReading(box_id, text)
+
+    def clearBoxText(self, box_id):
         """Clear the display."""
-        self.setBoxText(box_id, "")
+        self.setBoxText((box_id, ""))
 
 
 # Create a subclass of QMainWindow to setup the calculator's GUI
 class TemperatureUI(QMainWindow):
     """PyCalc's View (GUI)."""
 
-    def __init__(self, IP_ADDR, PORT, BASE_DIR):
-        """View initializer."""
+    def __init__(
+        self,
+        IP_ADDR,
+        PORT,
+        BASE_DIR,
+        SERVER_MODE="thread",
+        UI_FPS=10,
+        DISPLAY="grid",
+        METRICS_PORT=None,
+        SPOOL_DIR=None,
+        MAINTENANCE=None,
+    ):
+        """
+        View initializer.
+        DISPLAY -> "grid" (a box per sensor) or "table" (for hundreds of sensors)
+        METRICS_PORT -> serve prometheus metrics on this local port (None: off)
+        SPOOL_DIR -> readings still queued when the app quits are kept here and
+                     logged on the next start (None: off)
+        MAINTENANCE -> compress / archive / expire past days (see archive.py)
+        """
         super().__init__()
+        setup_console_log()
         # Set some main window's properties
         self.setWindowTitle("DataLogger")
         self.setFixedSize(800, 400)
@@ -140,12 +270,29 @@ class TemperatureUI(QMainWindow):
         self.setCentralWidget(central_widget)
 
         # add the display widget
-        self.display_grid = DisplayGrid()
+        if DISPLAY == "table":
+            self.display_grid = SensorTable()
+        else:
+            self.display_grid = DisplayGrid()
         main_layout.addWidget(self.display_grid.widget)
         self._createToolBars()
 
+        # push the latest readings to the display UI_FPS times a second
+        self.ui_updates = CoalescedUpdates()
+        self.ui_timer = QTimer(self)
+        self.ui_timer.timeout.connect(self.applyUpdates)
+        self.ui_timer.start(int(1000 / UI_FPS))
+
         # define logger, server
-        self.server = ESPLServer(IP_ADDR, PORT, BASE_DIR)
+        self.server = ESPLServer(
+            IP_ADDR,
+            PORT,
+            BASE_DIR,
+            MODE=SERVER_MODE,
+            METRICS_PORT=METRICS_PORT,
+            SPOOL_DIR=SPOOL_DIR,
+            MAINTENANCE=MAINTENANCE,
+        )
         self.startServerThread()
 
     def startServerThread(self):
@@ -154,11 +301,18 @@ class TemperatureUI(QMainWindow):
         server_thread = Worker(self.server.start_server)
         self.threadpool.start(server_thread)
 
-        # logger
+        # logger, reports readings to the coalescer instead of the progress signal
         logger_thread = Worker(self.server.LOGGER.write_msg_cache_to_file)
-        logger_thread.signals.progress.connect(self.display_grid.setBoxText)
+        logger_thread.kwargs["progress_callback"] = self.ui_updates
         self.threadpool.start(logger_thread)
 
+    def applyUpdates(self):
+        """Show the latest reading of every box which changed since the last tick."""
+        for sensor_id, reading in self.ui_updates.take().items():
+            self.display_grid.setBoxText(
+                (sensor_name(sensor_id), format_value(reading.value))
+            )
+
     def _createToolBars(self):
         # create actions
         self.settingsAction = QAction("Settings", self)
@@ -181,12 +335,29 @@ def main():
     PORT = 5050
     IP_ADDR = socket.gethostbyname(socket.gethostname())
     BASE_DIR = "/Users/kedar/code/data/"
+    SERVER_MODE = "selector"  # "thread" or "selector"
+    UI_FPS = 10  # display refreshes per second
+    DISPLAY = "grid"  # "grid" or "table" (hundreds of sensors)
+    METRICS_PORT = None  # 9100 -> http://127.0.0.1:9100/metrics
+    SPOOL_DIR = BASE_DIR + "spool/"  # None to disable
+    # gzip past days, keep everything (see archive.Maintenance), None to disable
+    MAINTENANCE = {"COMPRESS_AFTER_DAYS": 1, "DELETE_AFTER_DAYS": None}
 
     # Create an instance of QApplication
     app = QApplication(sys.argv)
 
     # Show the calculator's GUI
-    view = TemperatureUI(IP_ADDR, PORT, BASE_DIR)
+    view = TemperatureUI(
+        IP_ADDR,
+        PORT,
+        BASE_DIR,
+        SERVER_MODE,
+        UI_FPS,
+        DISPLAY,
+        METRICS_PORT,
+        SPOOL_DIR,
+        MAINTENANCE,
+    )
     view.show()
     app.aboutToQuit.connect(view.shutdown)
 
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""compression, monthly archives and retention of past days' log files
+
+tiers of a day's file YYYY/MM/DD[.shard<N>].csv (or .bin):
+    YYYY/MM/DD.csv -> the day being logged, plain
+    YYYY/MM/DD.csv.gz -> finished day, gzip (late records go to a new DD.csv,
+                         which the next pass appends to the .gz as a new member)
+    YYYY/MM.zip -> finished month, member DD.csv; the zip central directory
+                   is the index, a day is read without touching the others
+open_log() reads any of them as a stream, get_day_files() lists a day's files
+in all the tiers
+"""
+
+import os
+import re
+import gzip
+import glob
+import time
+import shutil
+import zipfile
+import argparse
+import datetime
+import threading
+from metrics import REGISTRY
+from console_log import get_log, setup_console_log
+from paths import str_format, get_MMYY_directory_path
+
+log = get_log("archive")
+
+# DD[.shard<N>].csv|.bin[.gz]
+DAY_FILE = re.compile(r"^(\d\d)((?:\.shard\d+)?)(\.csv|\.bin)(\.gz)?$")
+COPY_SIZE = 1 << 20
+CSV_HEADER = b"TIME,ID,TEMP"  # storage.CSVStorage.HEADER (storage imports archive)
+
+FILES_COMPRESSED = REGISTRY.counter(
+    "archive_files_compressed_total", "day files compressed to .gz"
+)
+FILES_ARCHIVED = REGISTRY.counter(
+    "archive_files_archived_total", "day files moved into a monthly archive"
+)
+FILES_DELETED = REGISTRY.counter(
+    "archive_files_deleted_total", "day files / archives removed by retention"
+)
+
+
+def get_archive_path(base_dir, dt):
+    """
+    YYYY/MM.zip of the month of dt
+    """
+    return get_MMYY_directory_path(base_dir, dt) + ".zip"
+
+
+def open_log(path):
+    """
+    open a log file for binary, streaming reads: a plain file, a .gz file or
+    a member of a monthly archive (path YYYY/MM.zip/DD.csv)
+    """
+    if os.path.exists(path):
+        if path.endswith(".gz"):
+            return gzip.open(path, "rb")
+        return open(path, "rb")
+    zip_path, name = os.path.split(path)
+    with zipfile.ZipFile(zip_path) as archive:
+        # the member keeps the archive file open until it is closed
+        return archive.open(name)
+
+
+def get_day_files(base_dir, date, ext):
+    """
+    every file of date with extension ext: archived, compressed and plain,
+    shards included, in that order
+    """
+    DD = str_format(date.day)
+    paths = []
+
+    zip_path = get_archive_path(base_dir, date)
+    if os.path.exists(zip_path):
+        with zipfile.ZipFile(zip_path) as archive:
+            for name in sorted(archive.namelist()):
+                match = DAY_FILE.match(name)
+                if match and match[1] == DD and match[3] == ext:
+                    paths.append(os.path.join(zip_path, name))
+
+    dir_path = get_MMYY_directory_path(base_dir, date)
+    found = sorted(glob.glob(os.path.join(dir_path, f"{DD}*{ext}*")))
+    compressed = [path for path in found if path.endswith(".gz")]
+    plain = [path for path in found if not path.endswith(".gz")]
+    for path in compressed + plain:
+        match = DAY_FILE.match(os.path.basename(path))
+        if match and match[3] == ext:
+            paths.append(path)
+    return paths
+
+
+def iter_day_files(base_dir):
+    """
+    yields (date, name, path) of every day file under base_dir, in all the
+    tiers. name is the plain file name (DD.csv), path is for open_log()
+    """
+    for year_dir in sorted(glob.glob(os.path.join(base_dir, "[0-9]" * 4))):
+        year = int(os.path.basename(year_dir))
+        for entry in sorted(os.listdir(year_dir)):
+            month_path = os.path.join(year_dir, entry)
+            if entry.endswith(".zip"):
+                with zipfile.ZipFile(month_path) as archive:
+                    names = sorted(archive.namelist())
+                paths = [os.path.join(month_path, name) for name in names]
+                month = entry[: -len(".zip")]
+            elif os.path.isdir(month_path):
+                names = sorted(os.listdir(month_path))
+                paths = [os.path.join(month_path, name) for name in names]
+                month = entry
+            else:
+                continue
+            for name, path in zip(names, paths):
+                match = DAY_FILE.match(name)
+                if match is None or not month.isdigit():
+                    continue
+                try:
+                    date = datetime.date(year, int(month), int(match[1]))
+                except ValueError:
+                    continue
+                yield date, match[1] + match[2] + match[3], path
+
+
+def remove_index(path):
+    """
+    drop the sensor index reader.py keeps next to a .bin file
+    """
+    if path.endswith(".gz"):
+        path = path[: -len(".gz")]
+    idx_path = os.path.splitext(path)[0] + ".idx.npz"
+    if os.path.exists(idx_path):
+        os.remove(idx_path)
+
+
+def compress_file(path, compresslevel=6):
+    """
+    DD.csv -> DD.csv.gz, appended as a new gzip member if the .gz exists
+    (without the csv header, the .gz already starts with one)
+    the plain file is removed once the .gz is complete
+    """
+    gz_path = path + ".gz"
+    tmp_path = gz_path + ".tmp"
+    append = os.path.exists(gz_path)
+    if append:
+        shutil.copyfile(gz_path, tmp_path)
+    with open(path, "rb") as src, open(tmp_path, "ab") as raw:
+        if append and path.endswith(".csv"):
+            if src.readline().rstrip(b"\r\n") != CSV_HEADER:
+                src.seek(0)
+        with gzip.GzipFile(
+            os.path.basename(path), "wb", compresslevel, raw, mtime=0
+        ) as dst:
+            shutil.copyfileobj(src, dst, COPY_SIZE)
+    os.replace(tmp_path, gz_path)
+    os.remove(path)
+    remove_index(path)
+    FILES_COMPRESSED.inc()
+
+
+def archive_month(base_dir, dt):
+    """
+    move the compressed day files of a finished month into YYYY/MM.zip
+    a day already in the archive (late records) stays as a .gz next to it
+    returns the number of files archived
+    """
+    dir_path = get_MMYY_directory_path(base_dir, dt)
+    zip_path = get_archive_path(base_dir, dt)
+    members = set()
+    if os.path.exists(zip_path):
+        with zipfile.ZipFile(zip_path) as archive:
+            members = set(archive.namelist())
+    archived = []
+    for gz_path in sorted(glob.glob(os.path.join(dir_path, "*.gz"))):
+        name = os.path.basename(gz_path)[: -len(".gz")]
+        if DAY_FILE.match(name) is not None and name not in members:
+            archived.append(gz_path)
+    if not archived:
+        return 0
+
+    # build the new archive next to the old one, a crash leaves the old intact
+    tmp_path = zip_path + ".tmp"
+    if members:
+        shutil.copyfile(zip_path, tmp_path)
+    with zipfile.ZipFile(
+        tmp_path, "a" if members else "w", zipfile.ZIP_DEFLATED, compresslevel=6
+    ) as archive:
+        for gz_path in archived:
+            name = os.path.basename(gz_path)[: -len(".gz")]
+            with gzip.open(gz_path, "rb") as src, archive.open(name, "w") as dst:
+                shutil.copyfileobj(src, dst, COPY_SIZE)
+    os.replace(tmp_path, zip_path)
+    for gz_path in archived:
+        os.remove(gz_path)
+    FILES_ARCHIVED.inc(len(archived))
+    try:
+        os.rmdir(dir_path)  # only if nothing else is left
+    except OSError:
+        pass
+    return len(archived)
+
+
+class Maintenance:
+    """
+    background thread: compresses finished days, rolls finished months into
+    archives and applies retention, every INTERVAL seconds
+    runs next to the logger, only touches files the logger is done with
+    """
+
+    def __init__(
+        self,
+        BASE_DIR,
+        COMPRESS_AFTER_DAYS=1,
+        ARCHIVE_AFTER_DAYS=None,
+        DELETE_AFTER_DAYS=None,
+        INTERVAL=3600,
+        QUIET_TIME=300,
+    ):
+        """
+        BASE_DIR -> the logger's BASE_DIR
+        COMPRESS_AFTER_DAYS -> gzip days older than this many days (None: never)
+        ARCHIVE_AFTER_DAYS -> zip months whose last day is older than this
+                              many days (None: never)
+        DELETE_AFTER_DAYS -> delete days older than this many days, archives
+                             once their last day is (None: keep everything)
+        INTERVAL -> seconds between two passes
+        QUIET_TIME -> files modified within this many seconds are left alone
+        """
+        self.BASE_DIR = BASE_DIR
+        self.COMPRESS_AFTER_DAYS = COMPRESS_AFTER_DAYS
+        self.ARCHIVE_AFTER_DAYS = ARCHIVE_AFTER_DAYS
+        self.DELETE_AFTER_DAYS = DELETE_AFTER_DAYS
+        self.INTERVAL = INTERVAL
+        self.QUIET_TIME = QUIET_TIME
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def is_before(self, date, days, today):
+        return days is not None and date < today - datetime.timedelta(days=days)
+
+    def run_once(self, today=None):
+        """
+        one maintenance pass, returns the counts of what was done
+        """
+        today = today or datetime.date.today()
+        counts = {"compressed": 0, "archived": 0, "deleted": 0}
+        months = {}  # (year, month) -> last day of the month
+        now = time.time()
+
+        for date, name, path in list(iter_day_files(self.BASE_DIR)):
+            month = date.replace(day=1)
+            months[month] = max(months.get(month, date), date)
+            if not os.path.exists(path):
+                continue  # archive member, handled per month below
+            if self.is_before(date, self.DELETE_AFTER_DAYS, today):
+                os.remove(path)
+                remove_index(path)
+                FILES_DELETED.inc()
+                counts["deleted"] += 1
+            elif (
+                not path.endswith(".gz")
+                and self.is_before(date, self.COMPRESS_AFTER_DAYS, today)
+                and now - os.path.getmtime(path) >= self.QUIET_TIME
+            ):
+                compress_file(path)
+                counts["compressed"] += 1
+
+        for month in sorted(months):
+            next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+            last_day = next_month - datetime.timedelta(days=1)
+            zip_path = get_archive_path(self.BASE_DIR, month)
+            if self.is_before(last_day, self.DELETE_AFTER_DAYS, today):
+                if os.path.exists(zip_path):
+                    os.remove(zip_path)
+                    FILES_DELETED.inc()
+                    counts["deleted"] += 1
+            elif self.is_before(last_day, self.ARCHIVE_AFTER_DAYS, today):
+                counts["archived"] += archive_month(self.BASE_DIR, month)
+
+        if any(counts.values()):
+            log.info("maintenance of %s: %s", self.BASE_DIR, counts)
+        return counts
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.run_once()
+            except (OSError, zipfile.BadZipFile) as e:
+                # a corrupt archive must not end the thread, retried next pass
+                log.warning("maintenance of %s failed: %s", self.BASE_DIR, e)
+            self.stopped.wait(self.INTERVAL)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("base_dir")
+    parser.add_argument("--compress-after", type=int, default=1, help="days")
+    parser.add_argument("--archive-after", type=int, help="days")
+    parser.add_argument("--delete-after", type=int, help="days")
+    parser.add_argument(
+        "--loop", type=float, help="repeat every LOOP seconds (default: run once)"
+    )
+    args = parser.parse_args()
+
+    setup_console_log()
+    maintenance = Maintenance(
+        args.base_dir,
+        args.compress_after,
+        args.archive_after,
+        args.delete_after,
+        INTERVAL=args.loop,
+    )
+    if args.loop is None:
+        print(maintenance.run_once())
+        return
+    try:
+        maintenance.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""end to end throughput benchmark: fleet of simulated sensors -> ESPLServer -> disk"""
+
+import os
+import json
+import time
+import heapq
+import socket
+import argparse
+import resource
+import tempfile
+import logging
+import threading
+import contextlib
+import multiprocessing
+from server import ESPLServer
+from framing import encode_text
+from console_log import setup_console_log
+
+
+def run_sensors(port, sensor_ids, rate, duration, mode, results):
+    """
+    load generator process: every sensor sends rate readings/s for duration seconds
+    mode -> "new" (connection per reading) or "persistent" (one connection per sensor)
+    """
+    addr = ("127.0.0.1", port)
+    conns = {}
+    sent = failed = 0
+
+    # (next due time, sensor id), sensors start spread over the first interval
+    start = time.monotonic()
+    interval = 1.0 / rate
+    due = [
+        (start + interval * i / len(sensor_ids), _id)
+        for i, _id in enumerate(sensor_ids)
+    ]
+    heapq.heapify(due)
+    end = start + duration
+
+    while due:
+        t, _id = heapq.heappop(due)
+        if t >= end:
+            continue
+        delay = t - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        frame = encode_text(f"{_id:03},{sent % 50}")
+        try:
+            if mode == "persistent":
+                if _id not in conns:
+                    conns[_id] = socket.create_connection(addr)
+                conns[_id].sendall(frame)
+            else:
+                with socket.create_connection(addr) as conn:
+                    conn.sendall(frame)
+            sent += 1
+        except OSError:
+            failed += 1
+            conn = conns.pop(_id, None)
+            if conn is not None:
+                conn.close()
+        heapq.heappush(due, (t + interval, _id))
+
+    for conn in conns.values():
+        conn.close()
+    results.put((sent, failed))
+
+
+class LatencyStorage:
+    """
+    wraps a storage backend, records the ingest (log) to disk latency
+    a record reaches the disk when it is flushed to the os, or fsynced if
+    the storage fsyncs
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.pending = []  # times of the records written since the last flush
+        self.latencies = []
+        self.batch_sizes = []
+
+    def on_disk(self):
+        now = time.time()
+        self.latencies.extend(now - ts for ts in self.pending)
+        self.pending = []
+
+    def write(self, records):
+        self.pending.extend(reading.ts for reading in records)
+        self.batch_sizes.append(len(records))
+        self.storage.write(records)
+        if self.storage.unflushed == 0 and not self.storage.FSYNC:
+            self.on_disk()  # flushed by the size / interval policy of write()
+
+    def flush(self):
+        self.storage.flush()
+        if not self.storage.FSYNC:
+            self.on_disk()
+
+    def sync(self):
+        self.storage.sync()
+        self.on_disk()
+
+    def close(self):
+        self.storage.close()
+        self.on_disk()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def get_rss_kb():
+    """current resident set size (linux), falls back to the peak"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_benchmark(
+    sensors,
+    rate,
+    duration,
+    mode,
+    server_mode,
+    storage,
+    processes,
+    base_dir,
+    drain_timeout=30,
+    durability="none",
+):
+    """
+    returns a dict of results, the load generators run in separate processes
+    so the cpu / memory numbers are the server's own
+    """
+    # every simulated sensor gets served, the limits are not what is measured
+    srv = ESPLServer(
+        "127.0.0.1",
+        0,
+        base_dir,
+        MODE=server_mode,
+        STORAGE=storage,
+        MAX_CLIENTS=max(sensors, 256),
+        MAX_CONNECTIONS=max(sensors, 4096),
+        DURABILITY=durability,
+    )
+    latency_storage = LatencyStorage(srv.LOGGER.STORAGE)
+    srv.LOGGER.STORAGE = latency_storage
+
+    server_thread = threading.Thread(target=srv.start_server, args=(None,))
+    logger_thread = threading.Thread(target=srv.LOGGER.write_msg_cache)
+    server_thread.start()
+    logger_thread.start()
+    time.sleep(0.2)
+
+    results = multiprocessing.Queue()
+    sensor_ids = list(range(1, sensors + 1))
+    procs = [
+        multiprocessing.Process(
+            target=run_sensors,
+            args=(srv.PORT, sensor_ids[i::processes], rate, duration, mode, results),
+        )
+        for i in range(min(processes, sensors))
+    ]
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.monotonic()
+    for proc in procs:
+        proc.start()
+    sent = failed = 0
+    for _ in procs:
+        s, f = results.get()
+        sent += s
+        failed += f
+    for proc in procs:
+        proc.join()
+    load_time = time.monotonic() - start
+
+    # wait for the logger to catch up with everything the server received
+    deadline = time.monotonic() + drain_timeout
+    while time.monotonic() < deadline:
+        received = srv.LOGGER.last_seq
+        if received >= sent - failed and srv.LOGGER.written_seq >= received:
+            break
+        time.sleep(0.05)
+    elapsed = time.monotonic() - start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    rss_kb = get_rss_kb()
+
+    srv.stop()
+    server_thread.join()
+    logger_thread.join()
+
+    written = sum(latency_storage.batch_sizes)
+    cpu = (usage_end.ru_utime - usage_start.ru_utime) + (
+        usage_end.ru_stime - usage_start.ru_stime
+    )
+    batches = latency_storage.batch_sizes
+    return {
+        "config": {
+            "sensors": sensors,
+            "rate_per_sensor": rate,
+            "duration_s": duration,
+            "connection_mode": mode,
+            "server_mode": server_mode,
+            "storage": storage,
+            "durability": durability,
+        },
+        "sent": sent,
+        "send_failures": failed,
+        "received": srv.LOGGER.last_seq,
+        "written": written,
+        "dropped": sent - written,
+        "queue_dropped": srv.LOGGER.MSG_CACHE.dropped,
+        "load_time_s": load_time,
+        "elapsed_s": elapsed,
+        "accepted_msgs_per_s": written / load_time if load_time else 0.0,
+        "latency_p50_ms": to_ms(percentile(latency_storage.latencies, 50)),
+        "latency_p99_ms": to_ms(percentile(latency_storage.latencies, 99)),
+        "latency_max_ms": to_ms(max(latency_storage.latencies, default=None)),
+        "mean_batch_size": sum(batches) / len(batches) if batches else 0.0,
+        "cpu_s": cpu,
+        "cpu_percent": 100 * cpu / elapsed if elapsed else 0.0,
+        "rss_kb": rss_kb,
+        "max_rss_kb": usage_end.ru_maxrss,
+    }
+
+
+def to_ms(seconds):
+    return None if seconds is None else 1000 * seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--sensors", type=int, default=100)
+    parser.add_argument(
+        "-r", "--rate", type=float, default=1.0, help="readings/s per sensor"
+    )
+    parser.add_argument(
+        "-d", "--duration", type=float, default=10.0, help="seconds of load"
+    )
+    parser.add_argument(
+        "-m", "--mode", choices=("new", "persistent"), default="persistent"
+    )
+    parser.add_argument(
+        "--server-mode", choices=("thread", "selector"), default="selector"
+    )
+    parser.add_argument("--storage", choices=("csv", "binary"), default="csv")
+    parser.add_argument(
+        "--durability", choices=("none", "interval", "batch"), default="none"
+    )
+    parser.add_argument(
+        "-p", "--processes", type=int, default=2, help="load generator processes"
+    )
+    parser.add_argument(
+        "--base-dir", help="log directory (default: a temporary directory)"
+    )
+    parser.add_argument(
+        "-o", "--out", help="write the json results here (default: stdout)"
+    )
+    args = parser.parse_args()
+
+    # persistent mode keeps a socket per sensor open on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    with contextlib.ExitStack() as stack:
+        base_dir = args.base_dir or stack.enter_context(tempfile.TemporaryDirectory())
+        # only warnings on the console during the measurement
+        setup_console_log(logging.WARNING)
+        result = run_benchmark(
+            args.sensors,
+            args.rate,
+            args.duration,
+            args.mode,
+            args.server_mode,
+            args.storage,
+            args.processes,
+            base_dir,
+            durability=args.durability,
+        )
+
+    output = json.dumps(result, indent=2)
+    if args.out is None:
+        print(output)
+    else:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""bulk import of historical csv log trees into columnar per day files
+
+BASE_DIR/YYYY/MM/DD[.shard<N>].csv (any tier, see archive.py), as written by
+the DataLogger or by the older server_excel.py, becomes OUT_DIR/YYYY/MM/DD.npz:
+    time, id, value -> the readings of the day in time order (RECORD_DTYPE)
+    stats_* -> per sensor count, min, max, mean, first and last time
+    malformed -> number of rows which could not be parsed
+the days are parsed in parallel processes, each file with numpy in chunks of
+whole lines. the header is optional, malformed rows are counted and skipped
+"""
+
+import os
+import csv
+import argparse
+import datetime
+import multiprocessing
+import numpy as np
+from storage import CSVStorage
+from reader import DTYPE
+from archive import open_log, iter_day_files
+from paths import get_DD_filepath
+from console_log import get_log, setup_console_log
+
+log = get_log("bulk_import")
+
+NEWLINE, CR, COMMA, COLON, ZERO = (ord(c) for c in "\n\r,:0")
+HEADER = np.frombuffer(CSVStorage.HEADER.encode(), dtype=np.uint8)
+BOM = b"\xef\xbb\xbf"
+ID_WIDTH = 10  # digits of the largest uint32
+ID_POWERS = 10 ** np.arange(ID_WIDTH - 1, -1, -1, dtype=np.int64)
+VALUE_WIDTH = 32
+SUMMARY_FILE = "days.csv"
+
+
+def gather(windows, starts, width):
+    """
+    (len(starts), width) array of the bytes buf[start:start + width]
+    windows -> sliding_window_view of buf (padded with zeros), rows are copied
+               whole instead of indexing every byte
+    """
+    return windows[starts, :width]
+
+
+def parse_rows(data, midnight):
+    """
+    parse complete HH:MM:SS,ID,TEMP lines (bytes ending with a newline)
+    returns the record array and the number of malformed rows
+    the header and blank lines are dropped without being counted
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    padded = np.zeros(len(buf) + VALUE_WIDTH + 1, dtype=np.uint8)
+    padded[: len(buf)] = buf
+    windows = np.lib.stride_tricks.sliding_window_view(padded, VALUE_WIDTH)
+    ends = np.flatnonzero(buf == NEWLINE)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    line_ends = ends - ((ends > starts) & (buf[np.maximum(ends - 1, 0)] == CR))
+    lengths = line_ends - starts
+
+    ignored = np.count_nonzero(lengths == 0)
+    candidates = np.flatnonzero(lengths == len(HEADER))
+    if len(candidates):
+        chars = gather(windows, starts[candidates], len(HEADER))
+        ignored += np.count_nonzero((chars == HEADER).all(axis=1))
+
+    # HH:MM:SS,ID,TEMP -> the first comma right after the time, exactly one
+    # more before the end of the line
+    chars = gather(windows, starts, 9)
+    rows = np.flatnonzero((lengths >= 12) & (chars[:, 8] == COMMA))
+    chars = chars[rows]
+    line_ends = line_ends[rows]
+    c1 = starts[rows] + 8
+    commas = np.append(np.flatnonzero(buf == COMMA), [len(buf), len(buf)])
+    next_comma = np.searchsorted(commas, c1, side="right")
+    c2 = commas[next_comma]
+    keep = (c2 < line_ends) & (commas[next_comma + 1] >= line_ends)
+
+    # HH:MM:SS
+    digits = chars - np.uint8(ZERO)  # wraps around for non digits
+    keep &= (chars[:, 2] == COLON) & (chars[:, 5] == COLON)
+    keep &= (digits[:, [0, 1, 3, 4, 6, 7]] <= 9).all(axis=1)
+    digits = digits.astype(np.int64)
+    HH = digits[:, 0] * 10 + digits[:, 1]
+    MM = digits[:, 3] * 10 + digits[:, 4]
+    SS = digits[:, 6] * 10 + digits[:, 7]
+    keep &= (HH < 24) & (MM < 60) & (SS < 60)
+
+    # ID, all digits, read right aligned so every row has the same powers of 10
+    id_len = c2 - c1 - 1
+    keep &= (id_len >= 1) & (id_len <= ID_WIDTH)
+    inside = np.arange(ID_WIDTH) >= ID_WIDTH - id_len[:, None]
+    digits = gather(windows, c2 - ID_WIDTH, ID_WIDTH) - np.uint8(ZERO)
+    digits[~inside] = 0
+    keep &= (digits <= 9).all(axis=1)
+    ids = digits.astype(np.int64) @ ID_POWERS
+    keep &= ids < 1 << 32
+
+    # TEMP, converted by numpy as fixed width strings
+    value_len = line_ends - c2 - 1
+    keep &= (value_len >= 1) & (value_len <= VALUE_WIDTH)
+    chars = gather(windows, c2 + 1, VALUE_WIDTH)
+    chars[np.arange(VALUE_WIDTH) >= value_len[:, None]] = 0
+    chars[~keep] = ord("0")
+    fields = np.ascontiguousarray(chars).view(f"S{VALUE_WIDTH}").ravel()
+    try:
+        values = fields.astype(np.float64)
+    except ValueError:
+        # slow path, only for chunks with a malformed value
+        values = np.zeros(len(fields))
+        for i, field in enumerate(fields):
+            try:
+                values[i] = float(field)
+            except ValueError:
+                keep[i] = False
+    keep &= np.isfinite(values)
+
+    records = np.zeros(np.count_nonzero(keep), dtype=DTYPE)
+    records["time"] = midnight + (HH * 3600 + MM * 60 + SS)[keep]
+    records["id"] = ids[keep]
+    records["value"] = values[keep]
+    return records, int(len(ends) - ignored - len(records))
+
+
+def read_chunks(f, CHUNK):
+    """
+    yields CHUNK bytes (and up to the end of the line) at a time
+    """
+    first = True
+    while True:
+        data = f.read(CHUNK)
+        if not data:
+            return
+        data += f.readline()
+        if first and data.startswith(BOM):
+            data = data[len(BOM) :]
+        first = False
+        if not data.endswith(b"\n"):
+            data += b"\n"
+        yield data
+
+
+def get_stats(records):
+    """
+    per sensor statistics of a record array, as a dict of arrays
+    """
+    order = np.argsort(records["id"], kind="stable")
+    ids, starts, counts = np.unique(
+        records["id"][order], return_index=True, return_counts=True
+    )
+    if len(ids) == 0:
+        empty = np.zeros(0)
+        return dict(
+            stats_id=ids,
+            stats_count=counts,
+            stats_min=empty,
+            stats_max=empty,
+            stats_mean=empty,
+            stats_first=empty,
+            stats_last=empty,
+        )
+    values = records["value"][order].astype(np.float64)
+    times = records["time"][order]
+    return dict(
+        stats_id=ids,
+        stats_count=counts,
+        stats_min=np.minimum.reduceat(values, starts),
+        stats_max=np.maximum.reduceat(values, starts),
+        stats_mean=np.add.reduceat(values, starts) / counts,
+        stats_first=np.minimum.reduceat(times, starts),
+        stats_last=np.maximum.reduceat(times, starts),
+    )
+
+
+def import_day(task):
+    """
+    worker process: parse the csv files of one day and write its .npz
+    task -> (date, csv paths, out path, CHUNK, COMPRESS)
+    returns the summary row of the day and the {path: malformed rows} of its
+    files with malformed rows (the console of the worker is not set up)
+    """
+    date, paths, out_path, CHUNK, COMPRESS = task
+    midnight = datetime.datetime.combine(date, datetime.time()).timestamp()
+    parts = []
+    skipped = {}
+    for path in paths:
+        with open_log(path) as f:
+            for data in read_chunks(f, CHUNK):
+                records, malformed = parse_rows(data, midnight)
+                parts.append(records)
+                if malformed:
+                    skipped[path] = skipped.get(path, 0) + malformed
+    malformed = int(sum(skipped.values()))
+
+    records = np.concatenate(parts) if parts else np.zeros(0, dtype=DTYPE)
+    # shards interleave, server_excel.py wrote its cache newest first
+    records = records[np.argsort(records["time"], kind="stable")]
+    stats = get_stats(records)
+    ids = stats["stats_id"]
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = out_path + ".tmp"
+    save = np.savez_compressed if COMPRESS else np.savez
+    with open(tmp_path, "wb") as f:
+        save(
+            f,
+            time=records["time"],
+            id=records["id"],
+            value=records["value"],
+            malformed=malformed,
+            **stats,
+        )
+    os.replace(tmp_path, out_path)
+    row = (date.isoformat(), len(paths), len(records), malformed, len(ids))
+    return row, skipped
+
+
+def load_day(path):
+    """
+    reads a .npz written by import_day, returns (records, stats)
+    """
+    with np.load(path) as f:
+        records = np.zeros(len(f["time"]), dtype=DTYPE)
+        for name in DTYPE.names:
+            records[name] = f[name]
+        stats = {name: f[name] for name in f.files if name.startswith("stats_")}
+        stats["malformed"] = int(f["malformed"])
+    return records, stats
+
+
+def import_tree(base_dir, out_dir, processes=None, CHUNK=8 << 20, COMPRESS=True):
+    """
+    import every csv day under base_dir into out_dir, processes days in parallel
+    (None: one per cpu, 1: in this process)
+    writes out_dir/days.csv and returns its rows, in date order
+    """
+    days = {}  # date -> csv files, in all tiers and shards
+    for date, name, path in iter_day_files(base_dir):
+        if name.endswith(".csv"):
+            days.setdefault(date, []).append(path)
+    tasks = [
+        (date, paths, get_DD_filepath(out_dir, ".npz", date), CHUNK, COMPRESS)
+        for date, paths in sorted(days.items())
+    ]
+
+    summary = []
+    if processes == 1:
+        results = map(import_day, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(import_day, tasks)
+    try:
+        for row, skipped in results:
+            for path, malformed in skipped.items():
+                log.warning("%s malformed rows skipped:: %s", malformed, path)
+            log.info("imported %s:: %s files, %s rows, %s malformed", *row[:4])
+            summary.append(row)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    summary.sort()
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, SUMMARY_FILE), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["DATE", "FILES", "ROWS", "MALFORMED", "SENSORS"])
+        writer.writerows(summary)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("base_dir")
+    parser.add_argument("out_dir")
+    parser.add_argument(
+        "-j", "--processes", type=int, help="worker processes (default: cpus)"
+    )
+    parser.add_argument(
+        "--chunk", type=int, default=8 << 20, help="bytes parsed at a time"
+    )
+    parser.add_argument(
+        "--no-compress", action="store_true", help="write plain (faster) .npz"
+    )
+    args = parser.parse_args()
+
+    setup_console_log()
+    summary = import_tree(
+        args.base_dir,
+        args.out_dir,
+        args.processes,
+        CHUNK=args.chunk,
+        COMPRESS=not args.no_compress,
+    )
+    rows = sum(row[2] for row in summary)
+    malformed = sum(row[3] for row in summary)
+    print(f"{len(summary)} days, {rows} rows, {malformed} malformed")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,14 @@
 import socket
 import time
+from framing import (
+    BINARY_HEADER,
+    VERSION,
+    encode_text,
+    encode_hello,
+    encode_reading,
+    encode_batch,
+    encode_text_batch,
+)
 
 HEADER = 4
 PORT = 5050
@@ -7,29 +16,140 @@ FORMAT = "utf-8"
 SERVER = "192.168.1.65"
 ADDR = (SERVER, PORT)
 ID = "004"
+BINARY = False  # compact binary frames instead of the ascii "   6004,23" format
+UDP = False  # fire and forget datagrams (needs the server's UDP_PORT), no connection
+BATCH_SIZE = 1  # > 1: send readings in batches of up to BATCH_SIZE
+BATCH_AGE = 10  # ... or once the oldest unsent reading is BATCH_AGE seconds old
 
 
-def send(msg):
-
+def connect():
+    """
+    open a connection to the server, reused for all the messages
+    """
     client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client.connect(ADDR)
     print(f"Connected to {ADDR}")
+    return client
+
+
+def send(client, msg):
+
     message = msg.encode(FORMAT)
     msg_length = len(message)
     send_length = str(msg_length).encode(FORMAT)
     send_length += b" " * (HEADER - len(send_length))
-    client.send(send_length)
-    client.send(message)
+    client.sendall(send_length + message)
     print(f"Msg sent to {ADDR}")
 
 
+def send_datagram(udp_client, msg):
+    """
+    send one ascii frame as a udp datagram, delivery is not guaranteed
+    """
+    udp_client.sendto(encode_text(msg, HEADER, FORMAT), ADDR)
+    print(f"Datagram sent to {ADDR}")
+
+
+def negotiate(client):
+    """
+    binary protocol: offer our version, returns the one the server picked
+    """
+    client.sendall(encode_hello(VERSION))
+    reply = b""
+    while len(reply) < BINARY_HEADER.size:
+        chunk = client.recv(BINARY_HEADER.size - len(reply))
+        if not chunk:
+            raise ConnectionError("server closed the connection")
+        reply += chunk
+    _, version, _, _ = BINARY_HEADER.unpack(reply)
+    print(f"binary protocol version {version}")
+    return version
+
+
+def send_reading(client, value):
+    """
+    binary protocol: send one reading, timestamped by the server
+    """
+    client.sendall(encode_reading(int(ID), value))
+    print(f"Reading sent to {ADDR}")
+
+
+class Batcher:
+    """
+    collects readings (of one or more sensors) and sends them as one batch
+    frame once MAX_COUNT readings are waiting or the oldest is MAX_AGE seconds old
+    every reading keeps the time it was taken
+    """
+
+    def __init__(self, client, MAX_COUNT=BATCH_SIZE, MAX_AGE=BATCH_AGE):
+        self.client = client
+        self.MAX_COUNT = MAX_COUNT
+        self.MAX_AGE = MAX_AGE
+        self.readings = []
+
+    def add(self, sensor_id, value):
+        self.readings.append((sensor_id, value, time.time()))
+        if (
+            len(self.readings) >= self.MAX_COUNT
+            or time.time() - self.readings[0][2] >= self.MAX_AGE
+        ):
+            self.flush()
+
+    def flush(self):
+        if not self.readings:
+            return
+        if BINARY:
+            self.client.sendall(
+                encode_batch([(int(_id), v, ts) for _id, v, ts in self.readings])
+            )
+        else:
+            # as many frames as the HEADER digit lengths need
+            self.client.sendall(encode_text_batch(self.readings, HEADER, FORMAT))
+        print(f"Batch of {len(self.readings)} readings sent to {ADDR}")
+        self.readings = []
+
+
 def main():
     print("starting client...")
+    if UDP:
+        udp_client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in range(10):
+            time.sleep(2)  # send msg every 2 seconds
+            send_datagram(udp_client, f"{ID},{i}")
+        udp_client.close()
+        return
+
+    client = connect()
+    if BINARY:
+        negotiate(client)
+    if BATCH_SIZE > 1:
+        batcher = Batcher(client)
+        for i in range(10):
+            time.sleep(2)  # take a reading every 2 seconds
+            batcher.add(ID, i)
+        batcher.flush()
+        client.close()
+        return
+
     for i in range(10):
         time.sleep(2)  # send msg every 2 seconds
         msg = f"{ID},{i}"
         print(f"sending msg to server...{i}")
-        send(msg)
+        try:
+            if BINARY:
+                send_reading(client, i)
+            else:
+                send(client, msg)
+        except OSError:
+            # server dropped the connection (e.g. idle timeout), reconnect once
+            client.close()
+            client = connect()
+            if BINARY:
+                negotiate(client)
+                send_reading(client, i)
+            else:
+                send(client, msg)
+    client.close()
 
 
 main()
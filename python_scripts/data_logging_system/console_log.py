@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""leveled console output handed to a background thread
+
+log calls only format and queue a record, a QueueListener thread does the
+(blocking) write to stderr, so a slow terminal or pipe can't stall the
+server or the logger. per message output is DEBUG and off by default.
+importing a module logs nothing anywhere, the scripts' entry points call
+setup_console_log()
+"""
+
+import sys
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+ROOT = "esplserver"
+logging.getLogger(ROOT).addHandler(logging.NullHandler())
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler on a bounded queue, drops (and counts) records when full
+    instead of blocking the caller
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SampleFilter(logging.Filter):
+    """
+    lets one in EVERY records below WARNING through
+    """
+
+    def __init__(self, EVERY):
+        super().__init__()
+        self.EVERY = EVERY
+        self.seen = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        self.seen += 1
+        return self.seen % self.EVERY == 0
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    at most RATE records per second below WARNING (token bucket, BURST deep)
+    """
+
+    def __init__(self, RATE, BURST=None):
+        super().__init__()
+        self.RATE = RATE
+        self.BURST = BURST or RATE
+        self.tokens = self.BURST
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.BURST, self.tokens + (now - self.last) * self.RATE)
+            self.last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+listener = None
+
+
+def setup_console_log(
+    LEVEL=logging.INFO, SAMPLE_EVERY=1, RATE_LIMIT=None, QUEUE_SIZE=10000, stream=None
+):
+    """
+    (re)configure the console output of the server / logger modules
+    LEVEL -> logging.DEBUG shows every message and connection
+    SAMPLE_EVERY -> only show one in SAMPLE_EVERY records below WARNING
+    RATE_LIMIT -> at most RATE_LIMIT records per second below WARNING
+    QUEUE_SIZE -> records waiting for the console, further records are dropped
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+
+    log_queue = queue.Queue(QUEUE_SIZE)
+    handler = DroppingQueueHandler(log_queue)
+    if SAMPLE_EVERY > 1:
+        handler.addFilter(SampleFilter(SAMPLE_EVERY))
+    if RATE_LIMIT is not None:
+        handler.addFilter(RateLimitFilter(RATE_LIMIT))
+
+    console = logging.StreamHandler(stream or sys.stderr)
+    console.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    listener = logging.handlers.QueueListener(log_queue, console)
+    listener.start()
+
+    root = logging.getLogger(ROOT)
+    root.handlers = [handler]
+    root.setLevel(LEVEL)
+    root.propagate = False
+    return handler
+
+
+def stop_console_log():
+    """
+    write out what is still queued
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+atexit.register(stop_console_log)
+
+
+def get_log(name):
+    """
+    logger for a module, silent until setup_console_log()
+    """
+    return logging.getLogger(f"{ROOT}.{name}")
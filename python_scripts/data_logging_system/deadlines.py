@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""connection deadlines"""
+
+import math
+import threading
+
+
+class TimerWheel:
+    """
+    hashed timer wheel holding one deadline per key (a connection)
+
+    a key sits in the slot of the tick its deadline falls in. moving a deadline
+    later only updates the dict, the key is moved when its old slot comes up.
+    so the per-frame cost of re-arming is a dict write, and expire() only looks
+    at the slots which passed since the last call.
+    """
+
+    def __init__(self, TICK=0.25, SLOTS=512):
+        """
+        TICK -> resolution of the deadlines in seconds
+        SLOTS -> number of slots, deadlines further out than TICK * SLOTS
+                 simply go around the wheel more than once
+        """
+        self.TICK = TICK
+        self.SLOTS = SLOTS
+        self.slots = [set() for _ in range(SLOTS)]
+        self.deadlines = {}  # key -> (deadline, reason)
+        self.scheduled = {}  # key -> tick of the slot the key sits in
+        self.current = None  # last tick expire() looked at
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def keys(self):
+        with self.lock:
+            return list(self.deadlines)
+
+    def reason(self, key):
+        entry = self.deadlines.get(key)
+        return entry[1] if entry is not None else None
+
+    def set(self, key, deadline, reason):
+        """
+        (re)arm the deadline of key, reason is handed back by expire()
+        """
+        tick = math.ceil(deadline / self.TICK)
+        with self.lock:
+            if self.current is not None and tick <= self.current:
+                tick = self.current + 1  # already due, the next expire() gets it
+            self.deadlines[key] = (deadline, reason)
+            scheduled = self.scheduled.get(key)
+            if scheduled is None or tick < scheduled:
+                self.slots[tick % self.SLOTS].add(key)
+                self.scheduled[key] = tick
+
+    def remove(self, key):
+        with self.lock:
+            self.deadlines.pop(key, None)
+            self.scheduled.pop(key, None)  # the slot entry goes stale
+
+    def expire(self, now):
+        """
+        remove and return [(key, reason), ...] of the deadlines before now
+        """
+        now_tick = math.floor(now / self.TICK)
+        expired = []
+        with self.lock:
+            if self.current is None:
+                self.current = now_tick - self.SLOTS
+            first = max(self.current + 1, now_tick - self.SLOTS + 1)
+            for tick in range(first, now_tick + 1):
+                slot = self.slots[tick % self.SLOTS]
+                for key in list(slot):
+                    scheduled = self.scheduled.get(key)
+                    if scheduled is None or scheduled % self.SLOTS != tick % self.SLOTS:
+                        slot.discard(key)  # removed or moved to an earlier slot
+                        continue
+                    if scheduled > now_tick:
+                        continue  # due on a later turn of the wheel
+                    slot.discard(key)
+                    deadline, reason = self.deadlines[key]
+                    if deadline <= now:
+                        expired.append((key, reason))
+                        del self.deadlines[key]
+                        del self.scheduled[key]
+                    else:
+                        # deadline was moved later, follow it
+                        later = math.ceil(deadline / self.TICK)
+                        self.slots[later % self.SLOTS].add(key)
+                        self.scheduled[key] = later
+            self.current = max(self.current, now_tick)
+        return expired
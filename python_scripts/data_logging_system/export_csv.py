@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""export the binary log files (see storage.BinaryStorage) to csv
+compressed (.bin.gz) and archived (YYYY/MM.zip) days are exported too
+"""
+
+import os
+import sys
+import argparse
+import datetime
+from storage import CSVStorage, read_binary_records
+from archive import iter_day_files
+from paths import get_MMYY_directory_path
+from readings import format_value, from_float32
+
+
+def format_row(record):
+    """
+    (time, id, value) -> TIME,ID,TEMP row, same format as the csv logger
+    """
+    ts, _id, value = record
+    current_time = datetime.datetime.fromtimestamp(ts).strftime("%H:%M:%S")
+    return f"{current_time},{_id:03},{format_value(from_float32(value))}\n"
+
+
+def export_file(bin_path, out, header=True):
+    """
+    write one .bin file as csv rows to the open file out
+    """
+    if header:
+        out.write(CSVStorage.HEADER + "\n")
+    count = 0
+    for record in read_binary_records(bin_path):
+        out.write(format_row(record))
+        count += 1
+    return count
+
+
+def export_tree(base_dir, out_dir):
+    """
+    export every YYYY/MM/DD.bin under base_dir to out_dir/YYYY/MM/DD.csv
+    a day in several tiers (late records of a compressed day) goes to one csv
+    """
+    days = {}  # csv path -> .bin sources
+    for date, name, path in iter_day_files(base_dir):
+        if not name.endswith(".bin"):
+            continue
+        csv_name = name[: -len(".bin")] + ".csv"
+        csv_path = os.path.join(get_MMYY_directory_path(out_dir, date), csv_name)
+        days.setdefault(csv_path, []).append(path)
+
+    for csv_path, bin_paths in days.items():
+        os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+        with open(csv_path, "w") as out:
+            for i, bin_path in enumerate(bin_paths):
+                count = export_file(bin_path, out, header=i == 0)
+                print(f"exported {count} records:: {bin_path} -> {csv_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path", help="a DD.bin file or a BASE_DIR tree")
+    parser.add_argument(
+        "-o", "--out", help="output csv file / directory (default: stdout)"
+    )
+    args = parser.parse_args()
+
+    if os.path.isdir(args.path):
+        if args.out is None:
+            parser.error("--out directory is needed to export a directory")
+        export_tree(args.path, args.out)
+    elif args.out is None:
+        export_file(args.path, sys.stdout)
+    else:
+        with open(args.out, "w") as out:
+            export_file(args.path, out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""length prefixed frame decoding
+
+two wire formats, detected from the first byte of a connection:
+    ascii  -> "<HEADER bytes: space padded ascii length><payload>", e.g. "   6001,23"
+    binary -> "<MAGIC><version><type><uint32 length><payload>" (network byte order)
+
+binary frame types:
+    HELLO   -> version negotiation, empty payload. the client sends the highest
+               version it speaks, the server answers with the version to use
+    READING -> one READING_RECORD: sensor id, unix time (0: use the server time), value
+    BATCH   -> any number of READING_RECORDs, possibly from several sensors
+
+an ascii payload can also carry a batch: "ID,value[,unix time];ID,value[,unix time];..."
+"""
+
+import struct
+
+MAGIC = 0xE5  # can't be the first byte of an ascii frame (space or digit)
+VERSION = 1  # highest binary protocol version the server speaks
+BINARY_HEADER = struct.Struct("!BBBI")  # magic, version, type, payload length
+READING_RECORD = struct.Struct("!IIf")  # sensor id, unix time, value
+
+# frame types, TEXT is an ascii frame
+TEXT = -1
+HELLO = 0
+READING = 1
+BATCH = 2
+
+
+def encode_text(msg, HEADER=4, FORMAT="utf-8"):
+    """
+    raises ValueError if the length of msg does not fit in HEADER digits
+    """
+    message = msg.encode(FORMAT)
+    if len(message) >= 10**HEADER:
+        raise ValueError(
+            f"text payload of {len(message)} bytes, the {HEADER} byte header "
+            f"allows {10**HEADER - 1}"
+        )
+    return str(len(message)).encode(FORMAT).ljust(HEADER) + message
+
+
+def encode_hello(version=VERSION):
+    return BINARY_HEADER.pack(MAGIC, version, HELLO, 0)
+
+
+def encode_reading(sensor_id, value, ts=0, version=VERSION):
+    payload = READING_RECORD.pack(sensor_id, int(ts), value)
+    return BINARY_HEADER.pack(MAGIC, version, READING, len(payload)) + payload
+
+
+def encode_batch(readings, version=VERSION):
+    """
+    readings -> list of (sensor id, value, unix time or 0)
+    """
+    payload = b"".join(
+        READING_RECORD.pack(_id, int(ts), value) for _id, value, ts in readings
+    )
+    return BINARY_HEADER.pack(MAGIC, version, BATCH, len(payload)) + payload
+
+
+def encode_text_batch(readings, HEADER=4, FORMAT="utf-8"):
+    """
+    readings -> list of (sensor id str, value, unix time or None)
+    split into as many frames as it takes to fit the HEADER digit lengths
+    """
+    frames = []
+    texts = []
+    size = -1  # no ";" before the first reading
+    for _id, value, ts in readings:
+        text = f"{_id},{value}" if ts is None else f"{_id},{value},{ts:.3f}"
+        length = len(text.encode(FORMAT)) + 1
+        if texts and size + length >= 10**HEADER:
+            frames.append(encode_text(";".join(texts), HEADER, FORMAT))
+            texts = []
+            size = -1
+        texts.append(text)
+        size += length
+    frames.append(encode_text(";".join(texts), HEADER, FORMAT))
+    return b"".join(frames)
+
+
+class FrameReader:
+    """
+    decodes the frames of one connection, ascii or binary (see above)
+
+    bytes are received with recv_into straight into a reusable buffer, a
+    frame is handed out as a memoryview of that buffer (no copy), which is
+    only valid until the next call to recv_into / next_frame
+    """
+
+    def __init__(self, HEADER=4, BUFFER_SIZE=16384, MAX_FRAME=1 << 20):
+        self.HEADER = HEADER
+        self.MAX_FRAME = MAX_FRAME
+
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        # the unread bytes are buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+        # None until the first byte arrives, then True / False for the connection
+        self.binary = None
+        self.version = VERSION
+
+    def make_room(self, needed):
+        """
+        make sure needed bytes fit after start, moving / growing the buffer
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        if self.start + needed <= len(self.buffer) and self.end < len(self.buffer):
+            return
+
+        unread = self.end - self.start
+        if needed > len(self.buffer):
+            # a memoryview is exported, so grow by copying into a new buffer
+            buffer = bytearray(max(needed, 2 * len(self.buffer)))
+            buffer[:unread] = self.view[self.start : self.end]
+            self.view.release()
+            self.buffer = buffer
+            self.view = memoryview(self.buffer)
+        else:
+            self.buffer[:unread] = self.buffer[self.start : self.end]
+        self.start = 0
+        self.end = unread
+
+    def recv_into(self, conn):
+        """
+        one recv_into from conn, returns the number of bytes read (0 on EOF)
+        """
+        self.make_room(self.HEADER)
+        n = conn.recv_into(self.view[self.end :])
+        self.end += n
+        return n
+
+    def next_frame(self):
+        """
+        returns (frame type, payload) of the next complete frame,
+        None if more bytes are needed
+        raises ValueError on a malformed header or an unsupported version
+        """
+        start, end = self.start, self.end
+        if start == end:
+            return None
+        if self.binary is None:
+            self.binary = self.buffer[start] == MAGIC
+
+        if self.binary:
+            header_size = BINARY_HEADER.size
+            if end - start < header_size:
+                return None
+            magic, version, frame_type, msg_length = BINARY_HEADER.unpack_from(
+                self.buffer, start
+            )
+            if magic != MAGIC:
+                raise ValueError(f"bad magic byte: {magic:#x}")
+            # a HELLO may offer a newer version, the answer negotiates it down
+            if frame_type != HELLO and not 1 <= version <= self.version:
+                raise ValueError(f"unsupported protocol version: {version}")
+        else:
+            header_size = self.HEADER
+            if end - start < header_size:
+                return None
+            msg_length = int(self.buffer[start : start + header_size])
+            frame_type = TEXT
+            version = None
+
+        if not 0 <= msg_length <= self.MAX_FRAME:
+            raise ValueError(f"bad frame length: {msg_length}")
+
+        frame_end = start + header_size + msg_length
+        if frame_end > end:
+            # make sure the rest of the frame will fit in the buffer
+            self.make_room(header_size + msg_length)
+            return None
+
+        self.start = frame_end
+        if frame_type == HELLO:
+            # agree on the highest version both ends speak
+            self.version = min(version, VERSION)
+        return frame_type, self.view[start + header_size : frame_end]
+
+    def recv_datagram(self, sock):
+        """
+        receive one datagram into the (emptied) buffer, returns (nbytes, addr)
+        every datagram is decoded on its own, it may use either wire format
+        """
+        self.start = self.end = 0
+        self.binary = None
+        self.version = VERSION
+        n, addr = sock.recvfrom_into(self.view)
+        self.end = n
+        return n, addr
+
+    def unread(self):
+        """
+        number of received bytes not yet returned as a frame
+        """
+        return self.end - self.start
@@ -1,141 +1,304 @@
 #!/usr/bin/env python3
 """logger class"""
 
-import os
-import datetime
-import csv
+import time
+import threading
+from msg_queue import MessageQueue
+from metrics import REGISTRY, SIZE_BUCKETS
+from storage import STORAGE_BACKENDS
+from readings import Reading, parse_reading
+from spool import Spool
+from console_log import get_log
 
+log = get_log("logger")
 
-def str_format(num):
-    """
-    correctly formats the data to be at least length 2
-    """
-    return "{:02}".format(num)
+WRITE_RETRY = 1.0  # seconds between attempts to write a batch the storage refused
 
+MESSAGES_LOGGED = REGISTRY.counter(
+    "datalogger_messages_total", "messages handed to the logger"
+)
+BATCH_SIZE = REGISTRY.histogram(
+    "datalogger_batch_size", "messages written per batch", buckets=SIZE_BUCKETS
+)
+WRITE_LATENCY = REGISTRY.histogram(
+    "datalogger_write_seconds", "time to write one batch"
+)
+INGEST_LATENCY = REGISTRY.histogram(
+    "datalogger_ingest_to_write_seconds",
+    "age of the oldest message of a batch when written",
+)
+COMMIT_SIZE = REGISTRY.histogram(
+    "datalogger_commit_size",
+    "messages made durable by one fsync (group commit)",
+    buckets=SIZE_BUCKETS,
+)
+WRITE_ERRORS = REGISTRY.counter(
+    "datalogger_write_errors_total",
+    "failed attempts to write a batch (out of file descriptors, disk full)",
+)
+UI_SIGNALS = REGISTRY.counter(
+    "datalogger_ui_signals_total", "progress_callback.emit calls"
+)
 
-def get_current_time_str():
-    dt = datetime.datetime.now()
-    HH = str_format(dt.hour)
-    MM = str_format(dt.minute)
-    SS = str_format(dt.second)
-    current_time = f"{HH}:{MM}:{SS}"
-    return current_time
 
-
-def get_DD_filepath(base_dir, ext=".csv"):
-    """
-    returns file path corresponding to the date
+class DataLogger:
     """
-    # get
-    dir_path = get_MMYY_directory_path(base_dir)
-
-    # get the file_name
-    dt = datetime.datetime.today()
-    day = str_format(dt.day) + ext
-    path = os.path.join(dir_path, day)
-
-    return path
-
+    class which handles the logging to the daily log files
 
-def get_MMYY_directory_path(base_dir):
+    DURABILITY decides when written messages are fsynced:
+        "none" -> never, the OS writes them back (fastest, a power loss
+                  drops what is still in the page cache)
+        "interval" -> at most every FSYNC_INTERVAL seconds
+        "batch" -> after every batch taken from the queue
+    one fsync covers all the messages written before it (group commit),
+    wait_durable() returns once a message is covered
     """
-    returns the current Month, year directory
-    """
-    dt = datetime.datetime.today()
-    year = str_format(dt.year)
-    month = str_format(dt.month)
-    path = os.path.join(base_dir, year)
-    path = os.path.join(path, month)
-    return path
-
 
-class DataLogger:
-    """
-    class which handles the logging to the csv file
-    """
+    DURABILITY_MODES = ("none", "interval", "batch")
 
-    def __init__(self, BASE_DIR):
+    def __init__(
+        self,
+        BASE_DIR,
+        QUEUE_SIZE=10000,
+        OVERFLOW_POLICY="block",
+        FLUSH_SIZE=100,
+        FLUSH_INTERVAL=1.0,
+        STORAGE="csv",
+        SHARD=None,
+        DURABILITY="none",
+        FSYNC_INTERVAL=0.1,
+        SPOOL_DIR=None,
+        CHECKPOINT_INTERVAL=1.0,
+    ):
         """
         initialization
+        QUEUE_SIZE -> max number of messages waiting to be written
+        OVERFLOW_POLICY -> "block", "drop_oldest" or "drop_newest" (see MessageQueue)
+        FLUSH_SIZE -> flush the log file after this many unflushed messages
+        FLUSH_INTERVAL -> flush the log file at least every FLUSH_INTERVAL seconds
+        STORAGE -> "csv", "binary" (see storage.py) or a storage object
+        SHARD -> write DD.shard<SHARD>.<ext> files (one shard per worker process)
+        DURABILITY -> "none", "interval" or "batch" (see above)
+        FSYNC_INTERVAL -> seconds between two fsyncs in "interval" mode
+        SPOOL_DIR -> keep a write-ahead spool of the queued messages here, they
+                     are replayed when a logger starts on the same directory
+                     (None: queued messages are lost if the process dies)
+        CHECKPOINT_INTERVAL -> seconds between two spool checkpoints
         """
+        if DURABILITY not in self.DURABILITY_MODES:
+            raise ValueError(f"unknown durability mode: {DURABILITY}")
+
         self.BASE_DIR = BASE_DIR
         self.CSV_HEADER = "TIME,ID,TEMP"
+        self.FLUSH_SIZE = FLUSH_SIZE
+        self.FLUSH_INTERVAL = FLUSH_INTERVAL
+        self.DURABILITY = DURABILITY
+        self.FSYNC_INTERVAL = FSYNC_INTERVAL
+        self.CHECKPOINT_INTERVAL = CHECKPOINT_INTERVAL
+
+        if isinstance(STORAGE, str):
+            if STORAGE not in STORAGE_BACKENDS:
+                raise ValueError(f"unknown storage backend: {STORAGE}")
+            STORAGE = STORAGE_BACKENDS[STORAGE](
+                BASE_DIR, FLUSH_SIZE, FLUSH_INTERVAL, SHARD, DURABILITY != "none"
+            )
+        self.STORAGE = STORAGE
+
+        # bounded FIFO queue of the Readings on their way to the storage
+        self.MSG_CACHE = MessageQueue(QUEUE_SIZE, OVERFLOW_POLICY)
 
-        # cache where threads write their messages
-        self.MSG_CACHE = []
+        # sequence numbers, stamped in arrival order by log()
+        self.seq_lock = threading.Lock()
+        self.last_seq = 0
+        self.written_seq = 0  # highest seq written to the log file
+
+        # group commit: highest seq covered by an fsync, waiters are woken together
+        self.durable_seq = 0
+        self.durable = threading.Condition()
+        self.last_sync = time.monotonic()
+
+        # write-ahead spool, numbering continues after the previous run's
+        self.spool = None
+        self.last_checkpoint = time.monotonic()
+        if SPOOL_DIR is not None:
+            self.spool = Spool(SPOOL_DIR, SYNC=DURABILITY != "none")
+            self.last_seq = self.spool.last_seq
+            self.written_seq = self.durable_seq = self.spool.checkpoint_seq
+
+        # scraped from this (the latest) logger
+        REGISTRY.gauge(
+            "datalogger_queue_depth",
+            "messages waiting to be written",
+            fn=lambda: len(self.MSG_CACHE),
+        )
+        REGISTRY.gauge(
+            "datalogger_queue_dropped",
+            "messages dropped by the queue overflow policy",
+            fn=lambda: self.MSG_CACHE.dropped,
+        )
 
         self.running = True
 
-    def initialize_DDMMYY_logfile(self):
+    def log(self, msg, ts=None):
         """
-        creates the log dir and initializes the logfile
+        add an "ID,value" message to the msg cache, returns its sequence number
+        ts -> unix time reported by the device, defaults to now
         """
+        ts_ns = None if ts is None else int(ts * 1e9)
+        return self.log_readings([parse_reading(msg, ts_ns)])
 
-        # create MMYY directory if needed
-        dir_path = get_MMYY_directory_path(self.BASE_DIR)
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path, exist_ok=False)
-
-        # initialize the CSV file if needed
-        file_path = get_DD_filepath(self.BASE_DIR)
-        if not os.path.exists(file_path):
-            with open(file_path, "w") as f:
-                f.write(self.CSV_HEADER + "\n")
-        return file_path
+    def log_reading(self, sensor_id, value, ts=None):
+        """
+        log one reading, ts -> unix time reported by the device, defaults to now
+        """
+        ts_ns = None if ts is None else int(ts * 1e9)
+        return self.log_readings([Reading(sensor_id, value, ts_ns)])
 
-    def log(self, msg):
+    def log_readings(self, readings):
         """
-        add message to the msg cache
+        add a batch of Readings to the msg cache in one operation
+        the arrival time (of readings without a device time) and the sequence
+        numbers are taken under the same lock as the put, so the queue (and
+        hence the log file) is ordered by arrival
+        returns the sequence number of the last reading queued, for
+        wait_durable(), None if the queue dropped them all
         """
-        current_time = get_current_time_str()
-        msg = f"{current_time},{msg}"
+        with self.seq_lock:
+            now = time.time_ns()
+            for reading in readings:
+                self.last_seq += 1
+                reading.seq = self.last_seq
+                if reading.ts_ns is None:
+                    reading.ts_ns = now
+            if self.spool is not None and readings:
+                self.spool.append(readings)
+            queued = self.MSG_CACHE.put_many(readings)
+        MESSAGES_LOGGED.inc(len(readings))
+        # with "drop_newest" only the head of the batch is queued, a dropped
+        # seq would never be written
+        return readings[queued - 1].seq if queued else None
 
-        self.MSG_CACHE.append(msg)
+    def wait_durable(self, seq, timeout=None):
+        """
+        block until the messages up to seq are written and, unless DURABILITY
+        is "none", fsynced. returns False on timeout or when the logger stops
+        """
+        with self.durable:
+            self.durable.wait_for(
+                lambda: self.durable_seq >= seq or not self.running, timeout
+            )
+            return self.durable_seq >= seq
 
-    def write_msg(self, msg):
+    def commit(self, force=False):
         """
-        write data to log file
+        writer thread: fsync as DURABILITY says and wake the waiters covered
         """
+        if self.durable_seq == self.written_seq:
+            return
+        if self.DURABILITY == "interval" and not force:
+            if time.monotonic() - self.last_sync < self.FSYNC_INTERVAL:
+                return
+        if self.DURABILITY != "none":
+            self.STORAGE.sync()
+            self.last_sync = time.monotonic()
+        COMMIT_SIZE.observe(self.written_seq - self.durable_seq)
+        with self.durable:
+            self.durable_seq = self.written_seq
+            self.durable.notify_all()
 
-        # initialize file path if needed
-        file_path = self.initialize_DDMMYY_logfile()
-        with open(file_path, "a") as f:
-            f.write(msg + "\n")
-        print(f"logged msg:: {msg} to file {file_path}")
+    def checkpoint(self, force=False):
+        """
+        writer thread: tell the spool which messages reached the daily store
+        """
+        if self.spool is None or self.durable_seq == self.spool.checkpoint_seq:
+            return
+        if not force and (
+            time.monotonic() - self.last_checkpoint < self.CHECKPOINT_INTERVAL
+        ):
+            return
+        # durable_seq may still sit in the file object's buffer with "none"
+        self.STORAGE.flush()
+        self.spool.checkpoint(self.durable_seq)
+        self.last_checkpoint = time.monotonic()
 
-    @staticmethod
-    def parse_msg(data_str):
+    def replay_spool(self, progress_callback=None, BATCH=1000):
         """
-        parses the msg from client and returns the id, temp
-        # format: TIME,ID,MSG
+        writer thread: write the Readings the previous run left in the spool
         """
-        _id = data_str.split(",")[1]
-        _temperature = data_str.split(",")[2]
-        return _id, _temperature
+        batch = []
+        for reading in self.spool.replay():
+            batch.append(reading)
+            if len(batch) >= BATCH:
+                self.write_batch(batch, progress_callback)
+                batch = []
+        if batch:
+            self.write_batch(batch, progress_callback)
+        self.commit(force=True)
+        self.checkpoint(force=True)
 
     def write_msg_cache_to_file(self, progress_callback):
         """
         message written to the csv log file, and send msg to
         """
+        timeout = self.FLUSH_INTERVAL
+        if self.DURABILITY == "interval":
+            timeout = min(timeout, self.FSYNC_INTERVAL)
+        if self.spool is not None:
+            self.replay_spool(progress_callback)
         while self.running:
-            if len(self.MSG_CACHE) > 0:
-                data_str = self.MSG_CACHE.pop()
-                box_id, temperature = self.parse_msg(data_str)
-                progress_callback.emit((box_id, temperature))
-                self.write_msg(data_str)
+            # sleeps until messages arrive, wakes up now and then to flush/check running
+            batch = self.MSG_CACHE.get_batch(timeout=timeout)
+            if not batch:
+                self.STORAGE.flush()
+                self.commit()
+                self.checkpoint()
+                continue
+            self.write_batch(batch, progress_callback)
+            self.commit()
+            self.checkpoint()
+
+        self.commit(force=True)
+        self.checkpoint(force=True)
+        self.STORAGE.close()
+        if self.spool is not None:
+            self.spool.close()
+        log.info("LOGGER stopped...")
+
+    def write_batch(self, batch, progress_callback):
+        """
+        write a batch of Readings, oldest first
+        """
+        if progress_callback is not None:
+            for reading in batch:
+                progress_callback.emit(reading)
+            UI_SIGNALS.inc(len(batch))
 
-        print("LOGGER stopped...")
+        start = time.perf_counter()
+        while True:
+            try:
+                self.STORAGE.write(batch)
+                break
+            except OSError as e:
+                # keep the batch and retry, the queue fills up behind it
+                WRITE_ERRORS.inc()
+                if not self.running:
+                    log.error("%s messages not written: %s", len(batch), e)
+                    return
+                log.error("writing %s messages failed, retrying: %s", len(batch), e)
+                time.sleep(WRITE_RETRY)
+        WRITE_LATENCY.observe(time.perf_counter() - start)
+        BATCH_SIZE.observe(len(batch))
+        INGEST_LATENCY.observe(time.time() - batch[0].ts)
+        self.written_seq = batch[-1].seq
 
     def write_msg_cache(self):
         """
         message written to the csv log file
         """
-        while self.running:
-            if len(self.MSG_CACHE) > 0:
-                data_str = self.MSG_CACHE.pop()
-                self.write_msg(data_str)
-
-        print("LOGGER stopped...")
+        self.write_msg_cache_to_file(None)
 
     def stop(self):
         self.running = False
+        self.MSG_CACHE.close()
+        with self.durable:
+            self.durable.notify_all()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""in process metrics (counters, gauges, histograms) served in prometheus text format"""
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, for the latency histograms
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+# messages, for the batch size histograms
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+class Counter:
+    """
+    monotonically increasing count
+    """
+
+    TYPE = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Gauge:
+    """
+    value which goes up and down, or is read from fn() at scrape time
+    """
+
+    TYPE = "gauge"
+
+    def __init__(self, name, help, fn=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def dec(self, n=1):
+        self.inc(-n)
+
+    def samples(self):
+        return [(self.name, self.fn() if self.fn is not None else self.value)]
+
+
+class Histogram:
+    """
+    counts of observations per bucket (upper bounds), plus their sum and count
+    """
+
+    TYPE = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + ("+Inf",), counts):
+            cumulative += n
+            samples.append((f'{self.name}_bucket{{le="{bound}"}}', cumulative))
+        samples.append((f"{self.name}_sum", total))
+        samples.append((f"{self.name}_count", count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    named metrics of the process, creating a metric twice returns the first one
+    (a gauge fn is replaced, so the latest logger / server instance is reported)
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get_or_create(self, cls, name, *args, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, *args, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help):
+        return self.get_or_create(Counter, name, help)
+
+    def gauge(self, name, help, fn=None):
+        gauge = self.get_or_create(Gauge, name, help)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.get_or_create(Histogram, name, help, buckets)
+
+    def render(self):
+        """
+        prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# the process wide registry used by the server and the logger
+REGISTRY = MetricsRegistry()
+
+
+def start_metrics_server(PORT, IP_ADDR="127.0.0.1", registry=REGISTRY):
+    """
+    serve GET /metrics from a daemon thread, returns the http server
+    (call .shutdown() to stop it)
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # no per scrape console output
+
+    httpd = ThreadingHTTPServer((IP_ADDR, PORT), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
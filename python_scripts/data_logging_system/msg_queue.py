@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""bounded message queue"""
+
+import threading
+from collections import deque
+
+
+class MessageQueue:
+    """
+    bounded FIFO queue between the server threads and the logger thread
+
+    OVERFLOW_POLICY decides what happens to a put_many on a full queue:
+        "block" -> wait until the logger makes space
+        "drop_oldest" -> discard the oldest queued message
+        "drop_newest" -> discard the message being put
+    """
+
+    POLICIES = ("block", "drop_oldest", "drop_newest")
+
+    def __init__(self, CAPACITY=10000, OVERFLOW_POLICY="block"):
+        if CAPACITY <= 0:
+            raise ValueError("queue capacity must be positive")
+        if OVERFLOW_POLICY not in self.POLICIES:
+            raise ValueError(f"unknown overflow policy: {OVERFLOW_POLICY}")
+
+        self.CAPACITY = CAPACITY
+        self.OVERFLOW_POLICY = OVERFLOW_POLICY
+
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.closed = False
+
+        # drop counters
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def dropped(self):
+        return self.dropped_oldest + self.dropped_newest
+
+    def put_many(self, msgs):
+        """
+        add a batch of messages in one go (one lock acquisition)
+        returns the number of messages of the batch which were queued
+        """
+        with self.lock:
+            queued = 0
+            for i, msg in enumerate(msgs):
+                if len(self.items) >= self.CAPACITY:
+                    if self.OVERFLOW_POLICY == "drop_newest":
+                        self.dropped_newest += len(msgs) - i
+                        break
+                    if self.OVERFLOW_POLICY == "drop_oldest":
+                        self.items.popleft()
+                        self.dropped_oldest += 1
+                    else:
+                        # let the logger see what is queued so far, then wait for space
+                        self.not_empty.notify()
+                        while len(self.items) >= self.CAPACITY and not self.closed:
+                            self.not_full.wait()
+                if self.closed:
+                    self.dropped_newest += len(msgs) - i
+                    break
+
+                self.items.append(msg)
+                queued += 1
+
+            if queued:
+                self.not_empty.notify()
+            return queued
+
+    def get_batch(self, max_items=None, timeout=None):
+        """
+        remove all the queued messages (at most max_items) in one go
+        sleeps while the queue is empty, returns [] on timeout
+        """
+        with self.lock:
+            if not self.items and not self.closed:
+                self.not_empty.wait(timeout)
+
+            if max_items is None or max_items >= len(self.items):
+                batch = list(self.items)
+                self.items.clear()
+            else:
+                batch = [self.items.popleft() for _ in range(max_items)]
+            if batch:
+                self.not_full.notify_all()
+            return batch
+
+    def close(self):
+        """
+        wake up every waiting thread, further puts are dropped
+        """
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""date based paths for the log files"""
+
+import os
+import datetime
+
+
+def str_format(num):
+    """
+    correctly formats the data to be at least length 2
+    """
+    return "{:02}".format(num)
+
+
+def get_current_time_str(dt=None):
+    if dt is None:
+        dt = datetime.datetime.now()
+    HH = str_format(dt.hour)
+    MM = str_format(dt.minute)
+    SS = str_format(dt.second)
+    current_time = f"{HH}:{MM}:{SS}"
+    return current_time
+
+
+def get_DD_filepath(base_dir, ext=".csv", dt=None):
+    """
+    returns file path corresponding to the date
+    """
+    # read the clock once, so the directory and the file agree at midnight
+    if dt is None:
+        dt = datetime.datetime.today()
+    dir_path = get_MMYY_directory_path(base_dir, dt)
+
+    # get the file_name
+    day = str_format(dt.day) + ext
+    path = os.path.join(dir_path, day)
+
+    return path
+
+
+def get_MMYY_directory_path(base_dir, dt=None):
+    """
+    returns the current Month, year directory
+    """
+    if dt is None:
+        dt = datetime.datetime.today()
+    year = str_format(dt.year)
+    month = str_format(dt.month)
+    path = os.path.join(base_dir, year)
+    path = os.path.join(path, month)
+    return path
+
+
+class DateCache:
+    """
+    caches the per day and per second strings, so that the time string and
+    the date of a message come from a single clock read
+
+    the day is recomputed only once the clock passes the next midnight,
+    the HH:MM:SS string once per second
+    not thread safe, use one instance per thread (or under a lock)
+    """
+
+    def __init__(self):
+        self.date = None
+        self.day_start = 0.0
+        self.next_midnight = 0.0
+
+        self.second = None
+        self.time_str = None
+
+    def set_day(self, ts):
+        dt = datetime.datetime.fromtimestamp(ts)
+        midnight = datetime.datetime.combine(dt.date(), datetime.time())
+        self.date = dt.date()
+        self.day_start = midnight.timestamp()
+        self.next_midnight = (midnight + datetime.timedelta(days=1)).timestamp()
+
+    def get_date(self, ts):
+        """
+        returns the (local) datetime.date of the unix time ts
+        """
+        if not self.day_start <= ts < self.next_midnight:
+            self.set_day(ts)
+        return self.date
+
+    def get_time_str(self, ts):
+        """
+        returns the HH:MM:SS string of the unix time ts
+        """
+        second = int(ts)
+        if second != self.second:
+            self.second = second
+            self.time_str = get_current_time_str(
+                datetime.datetime.fromtimestamp(second)
+            )
+        return self.time_str
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""read the daily log files back as numpy arrays
+
+compressed (.gz) and archived (YYYY/MM.zip) days are read transparently,
+see archive.py
+"""
+
+import io
+import os
+import csv
+import datetime
+import numpy as np
+from storage import RECORD_DTYPE
+from archive import open_log, get_day_files
+
+DTYPE = np.dtype(RECORD_DTYPE)
+
+
+def get_index_path(path):
+    """
+    DD.bin -> DD.idx.npz
+    """
+    return os.path.splitext(path)[0] + ".idx.npz"
+
+
+def memmap_day(path):
+    """
+    memory maps a .bin log file, returns a (possibly empty) record array
+    a partially written trailing record is ignored
+    """
+    rows = os.path.getsize(path) // DTYPE.itemsize
+    if rows == 0:
+        return np.zeros(0, dtype=DTYPE)
+    return np.memmap(path, dtype=DTYPE, mode="r", shape=(rows,))
+
+
+def read_compressed_day(path):
+    """
+    record array of a compressed or archived .bin file (decompressed in memory)
+    """
+    with open_log(path) as f:
+        data = f.read()
+    rows = len(data) // DTYPE.itemsize
+    return np.frombuffer(data, dtype=DTYPE, count=rows)
+
+
+class SensorIndex:
+    """
+    per file sensor index: the row numbers of the file sorted by sensor id
+    rows of sensor ids[i] are order[starts[i]:ends[i]], still in time order
+    """
+
+    def __init__(self, rows, ids, starts, ends, order):
+        self.rows = rows  # number of records covered by the index
+        self.ids = ids
+        self.starts = starts
+        self.ends = ends
+        self.order = order
+
+    @classmethod
+    def build(cls, records):
+        order = np.argsort(records["id"], kind="stable")
+        ids, starts, counts = np.unique(
+            records["id"][order], return_index=True, return_counts=True
+        )
+        return cls(len(records), ids, starts, starts + counts, order)
+
+    @classmethod
+    def load(cls, idx_path):
+        with np.load(idx_path) as f:
+            return cls(int(f["rows"]), f["ids"], f["starts"], f["ends"], f["order"])
+
+    def save(self, idx_path):
+        tmp_path = idx_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                rows=self.rows,
+                ids=self.ids,
+                starts=self.starts,
+                ends=self.ends,
+                order=self.order,
+            )
+        os.replace(tmp_path, idx_path)
+
+    def get_rows(self, sensor_id):
+        """
+        row numbers of sensor_id, in file (time) order
+        """
+        i = np.searchsorted(self.ids, sensor_id)
+        if i == len(self.ids) or self.ids[i] != sensor_id:
+            return np.zeros(0, dtype=np.intp)
+        return self.order[self.starts[i] : self.ends[i]]
+
+
+def get_index(path, records):
+    """
+    loads the sensor index of a .bin file, (re)builds it if the file has grown
+    """
+    idx_path = get_index_path(path)
+    if os.path.exists(idx_path):
+        index = SensorIndex.load(idx_path)
+        if index.rows == len(records):
+            return index
+
+    index = SensorIndex.build(records)
+    try:
+        index.save(idx_path)
+    except OSError:
+        pass  # read only store, use the in memory index
+    return index
+
+
+def read_csv_day(path, date):
+    """
+    slow path for days stored as csv, returns a record array
+    """
+    midnight = datetime.datetime.combine(date, datetime.time()).timestamp()
+    times, ids, values = [], [], []
+    with io.TextIOWrapper(open_log(path), newline="") as f:
+        for row in csv.reader(f):
+            try:
+                HH, MM, SS = row[0].split(":")
+                ts = midnight + int(HH) * 3600 + int(MM) * 60 + int(SS)
+                _id, value = int(row[1]), float(row[2])
+            except (ValueError, IndexError):
+                continue  # header or malformed row
+            times.append(ts)
+            ids.append(_id)
+            values.append(value)
+
+    records = np.zeros(len(times), dtype=DTYPE)
+    records["time"] = times
+    records["id"] = ids
+    records["value"] = values
+    return records
+
+
+def read_file(path, date, sensor_id=None):
+    """
+    records of one .bin (memory mapped) or .csv (parsed) file
+    """
+    if path.endswith(".bin") and os.path.exists(path):
+        records = memmap_day(path)
+        if sensor_id is not None:
+            records = records[get_index(path, records).get_rows(sensor_id)]
+    elif ".bin" in os.path.basename(path):
+        records = read_compressed_day(path)
+        if sensor_id is not None:
+            records = records[records["id"] == sensor_id]
+    else:
+        records = read_csv_day(path, date)
+        if sensor_id is not None:
+            records = records[records["id"] == sensor_id]
+    return records
+
+
+def query_day(base_dir, date, sensor_id=None):
+    """
+    returns (time, value) arrays of one day, optionally only for sensor_id
+    the shards of a multi process server (and late records of a compressed
+    day) are merged by time, the rows of a file are in arrival order (device
+    times may go back) so they are sorted too
+    """
+    paths = get_day_files(base_dir, date, ".bin") or get_day_files(
+        base_dir, date, ".csv"
+    )
+    parts = [read_file(path, date, sensor_id) for path in paths]
+
+    if not parts:
+        records = np.zeros(0, dtype=DTYPE)
+    else:
+        records = np.concatenate(parts)
+        records = records[np.argsort(records["time"], kind="stable")]
+
+    return np.asarray(records["time"]), np.asarray(records["value"])
+
+
+def query_range(base_dir, start_date, end_date, sensor_id=None):
+    """
+    returns (time, value) arrays from start_date to end_date (both included)
+    """
+    times, values = [], []
+    date = start_date
+    while date <= end_date:
+        t, v = query_day(base_dir, date, sensor_id)
+        times.append(t)
+        values.append(v)
+        date += datetime.timedelta(days=1)
+
+    if not times:
+        return np.zeros(0, dtype=DTYPE["time"]), np.zeros(0, dtype=DTYPE["value"])
+    return np.concatenate(times), np.concatenate(values)
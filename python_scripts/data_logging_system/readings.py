@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""typed sensor readings, parsed once when a frame arrives"""
+
+import struct
+import threading
+
+# ids of sensors whose names are not the "%03d" of a uint32 are handed out
+# from here up, so every name is written back exactly as it was received
+NAME_BASE = 1 << 32
+MAX_NAMES = 65536  # the table never shrinks, a flood of bogus names stops here
+sensor_names = []  # id - NAME_BASE -> name
+sensor_numbers = []  # id - NAME_BASE -> int value of an all digit name, or None
+sensor_ids = {}  # name -> id
+names_lock = threading.Lock()
+FLOAT32 = struct.Struct("<f")
+MAX_TIME = 1 << 32  # device times have the range of the binary frames' uint32
+
+
+def intern_sensor_id(text):
+    """
+    "007" -> 7, other names ("7", "0007", "kitchen") get a process wide
+    id >= NAME_BASE
+    raises ValueError for a new name once MAX_NAMES names are interned
+    """
+    text = text.strip()
+    if not text:
+        raise ValueError("empty sensor id")
+    if text.isdigit() and int(text) < NAME_BASE and f"{int(text):03}" == text:
+        return int(text)
+    sensor_id = sensor_ids.get(text)
+    if sensor_id is None:
+        with names_lock:
+            sensor_id = sensor_ids.get(text)
+            if sensor_id is None:
+                if len(sensor_names) >= MAX_NAMES:
+                    raise ValueError(f"too many sensor names: {text!r}")
+                sensor_id = NAME_BASE + len(sensor_names)
+                number = int(text) if text.isdigit() else None
+                if number is not None and number >= NAME_BASE:
+                    number = None
+                sensor_names.append(text)
+                sensor_numbers.append(number)
+                sensor_ids[text] = sensor_id
+    return sensor_id
+
+
+def sensor_name(sensor_id):
+    """
+    7 -> "007", the name of an interned id
+    """
+    if sensor_id >= NAME_BASE:
+        return sensor_names[sensor_id - NAME_BASE]
+    return f"{sensor_id:03}"
+
+
+def sensor_number(sensor_id):
+    """
+    the uint32 id of a sensor ("0007" -> 7), None for non numeric names
+    """
+    if sensor_id >= NAME_BASE:
+        return sensor_numbers[sensor_id - NAME_BASE]
+    return sensor_id
+
+
+def from_float32(value):
+    """
+    the shortest decimal which is the same float32 as value (21.299999237060547
+    of a binary frame -> 21.3), so the csv shows what the device sent
+    """
+    for digits in range(6, 10):
+        rounded = float(f"{value:.{digits}g}")
+        if FLOAT32.unpack(FLOAT32.pack(rounded))[0] == value:
+            return rounded
+    return value
+
+
+def format_value(value):
+    """
+    shortest text which reads back as the same float, "23" for 23.0
+    """
+    text = repr(value)
+    return text[:-2] if text.endswith(".0") else text
+
+
+class Reading:
+    """
+    one reading on its way from the socket to the sinks
+    sensor_id -> int (see intern_sensor_id)
+    value -> float
+    ts_ns -> unix time in nanoseconds from the device, None until the
+             DataLogger stamps the arrival time
+    seq -> arrival order, stamped by the DataLogger
+    """
+
+    __slots__ = ("seq", "sensor_id", "value", "ts_ns")
+
+    def __init__(self, sensor_id, value, ts_ns, seq=0):
+        self.seq = seq
+        self.sensor_id = sensor_id
+        self.value = value
+        self.ts_ns = ts_ns
+
+    @property
+    def ts(self):
+        """unix time in seconds"""
+        return self.ts_ns / 1e9
+
+    def __repr__(self):
+        return (
+            f"Reading({sensor_name(self.sensor_id)}, {format_value(self.value)}, "
+            f"{self.ts_ns}, seq={self.seq})"
+        )
+
+
+def parse_reading(text, ts_ns=None):
+    """
+    "ID,value[,unix time]" -> Reading, with ts_ns if the text has no time
+    raises ValueError on malformed text and on times outside [0, MAX_TIME)
+    """
+    fields = text.split(",")
+    if len(fields) == 3:
+        ts = float(fields[2])
+        if not 0 <= ts < MAX_TIME:  # nan and inf too
+            raise ValueError(f"device time out of range: {text!r}")
+        ts_ns = int(ts * 1e9)
+    elif len(fields) != 2:
+        raise ValueError(f"malformed reading: {text!r}")
+    return Reading(intern_sensor_id(fields[0]), float(fields[1]), ts_ns)
@@ -2,22 +2,165 @@
 """esplserver"""
 
 import time
+import queue
 import socket
+import struct
+import selectors
 import threading
+import collections
 from logger import DataLogger
+from readings import Reading, parse_reading, from_float32
+from framing import (
+    FrameReader,
+    TEXT,
+    HELLO,
+    READING,
+    BATCH,
+    READING_RECORD,
+    encode_hello,
+)
+from metrics import REGISTRY, start_metrics_server
+from deadlines import TimerWheel
+from archive import Maintenance
+from console_log import get_log
 import time
 
+log = get_log("server")
+
+ACCEPT_BACKOFF = 0.5  # seconds without accepting after accept() failed
+
+CONNECTIONS_ACCEPTED = REGISTRY.counter(
+    "esplserver_connections_accepted_total", "tcp connections accepted"
+)
+CONNECTIONS_ACTIVE = REGISTRY.gauge(
+    "esplserver_connections_active", "open tcp connections"
+)
+FRAMES_RECEIVED = REGISTRY.counter(
+    "esplserver_frames_total", "frames received, tcp and udp"
+)
+BYTES_RECEIVED = REGISTRY.counter(
+    "esplserver_bytes_received_total", "bytes received, tcp and udp"
+)
+PARSE_ERRORS = REGISTRY.counter(
+    "esplserver_parse_errors_total", "malformed frames / datagrams, tcp and udp"
+)
+CONNECTIONS_SHED = REGISTRY.counter(
+    "esplserver_connections_shed_total",
+    "tcp connections closed unserved because the server was saturated",
+)
+TIMEOUTS = {
+    "first byte": REGISTRY.counter(
+        "esplserver_first_byte_timeouts_total",
+        "connections dropped for sending nothing within FIRST_BYTE_TIMEOUT",
+    ),
+    "frame": REGISTRY.counter(
+        "esplserver_frame_timeouts_total",
+        "connections dropped for not completing a frame within FRAME_TIMEOUT",
+    ),
+    "idle": REGISTRY.counter(
+        "esplserver_idle_timeouts_total",
+        "connections closed after IDLE_TIMEOUT without a frame",
+    ),
+}
+ACCEPT_ERRORS = REGISTRY.counter(
+    "esplserver_accept_errors_total",
+    "accept() failures (e.g. out of file descriptors), accepting backs off",
+)
+UDP_DATAGRAMS = REGISTRY.counter(
+    "esplserver_udp_datagrams_total", "udp datagrams received"
+)
+UDP_DUPLICATES = REGISTRY.counter(
+    "esplserver_udp_duplicates_total", "udp datagrams dropped as duplicates"
+)
+
 
 class ESPLServer:
-    def __init__(self, IP_ADDR, PORT, SAVE_DIR):
+    def __init__(
+        self,
+        IP_ADDR,
+        PORT,
+        SAVE_DIR,
+        MODE="thread",
+        IDLE_TIMEOUT=60,
+        FIRST_BYTE_TIMEOUT=10,
+        FRAME_TIMEOUT=5,
+        STORAGE="csv",
+        UDP_PORT=None,
+        UDP_DEDUP_WINDOW=1.0,
+        REUSE_PORT=False,
+        SHARD=None,
+        METRICS_PORT=None,
+        MAX_CLIENTS=256,
+        MAX_CONNECTIONS=4096,
+        ACCEPT_BACKLOG=128,
+        SATURATION_POLICY="wait",
+        DURABILITY="none",
+        FSYNC_INTERVAL=0.1,
+        SPOOL_DIR=None,
+        MAINTENANCE=None,
+    ):
         """
         IP_ADDR -> IP addr of the server
         PORT -> server port number
         SAVE_DIR -> location to store data
+        MODE -> "thread" (one thread per connection) or
+                "selector" (all connections on a single event loop)
+        IDLE_TIMEOUT -> seconds a connection may stay silent between frames
+        FIRST_BYTE_TIMEOUT -> seconds from accept to the first byte
+        FRAME_TIMEOUT -> seconds from the first to the last byte of a frame
+        STORAGE -> DataLogger storage backend, "csv" or "binary"
+        UDP_PORT -> also accept frames as UDP datagrams on this port (None: no UDP)
+        UDP_DEDUP_WINDOW -> identical datagrams from the same address within
+                            this many seconds are dropped as duplicates, if
+                            all their readings carry a device time
+        REUSE_PORT -> bind with SO_REUSEPORT, so several processes share the port
+        SHARD -> log to the DD.shard<SHARD> files (see workers.py)
+        METRICS_PORT -> serve prometheus metrics on http://127.0.0.1:METRICS_PORT/metrics
+        MAX_CLIENTS -> thread mode: connections served at once (size of the
+                       handler pool)
+        MAX_CONNECTIONS -> selector mode: connections open at once, an idle
+                           persistent connection only costs a socket here
+        ACCEPT_BACKLOG -> accepted connections waiting for a free handler,
+                          also the listen() backlog
+        SATURATION_POLICY -> when MAX_CLIENTS are busy and the backlog is full
+                             (selector mode: MAX_CONNECTIONS are open),
+                             "wait" (stop accepting, the kernel queue holds the rest)
+                             or "shed" (accept and close right away)
+        DURABILITY -> DataLogger fsync policy, "none", "interval" or "batch"
+                      in thread mode with "batch" a connection is read again only
+                      once its frames are fsynced, so a stalled disk slows
+                      the senders down instead of losing acknowledged data
+        FSYNC_INTERVAL -> seconds between fsyncs in "interval" mode
+        SPOOL_DIR -> DataLogger write-ahead spool directory (None: no spool)
+        MAINTENANCE -> archive.Maintenance arguments, e.g. {"DELETE_AFTER_DAYS": 365},
+                       to compress / archive / expire past days of SAVE_DIR in a
+                       background thread (None: off)
         """
+        if MODE not in ("thread", "selector"):
+            raise ValueError(f"unknown server mode: {MODE}")
+        if SATURATION_POLICY not in ("wait", "shed"):
+            raise ValueError(f"unknown saturation policy: {SATURATION_POLICY}")
+
         self.IP_ADDR = IP_ADDR
         self.PORT = PORT
-        self.LOGGER = DataLogger(SAVE_DIR)  # initialize the logger
+        self.MODE = MODE
+        self.IDLE_TIMEOUT = IDLE_TIMEOUT
+        self.FIRST_BYTE_TIMEOUT = FIRST_BYTE_TIMEOUT
+        self.FRAME_TIMEOUT = FRAME_TIMEOUT
+        self.UDP_PORT = UDP_PORT
+        self.UDP_DEDUP_WINDOW = UDP_DEDUP_WINDOW
+        self.REUSE_PORT = REUSE_PORT
+        self.MAX_CLIENTS = MAX_CLIENTS
+        self.ACCEPT_BACKLOG = ACCEPT_BACKLOG
+        self.SATURATION_POLICY = SATURATION_POLICY
+        self.LOGGER = DataLogger(
+            SAVE_DIR,
+            STORAGE=STORAGE,
+            SHARD=SHARD,
+            DURABILITY=DURABILITY,
+            FSYNC_INTERVAL=FSYNC_INTERVAL,
+            SPOOL_DIR=SPOOL_DIR,
+        )  # initialize the logger
 
         self.HEADER = 4  # size of the header
         self.FORMAT = "utf-8"
@@ -27,13 +170,79 @@ class ESPLServer:
 
         # initialize the server
         self.server = self.initialize_server()
-        self.client_threads = []
+
+        # thread mode: pool of handlers fed from a bounded accept queue
+        self.pending = queue.Queue(maxsize=ACCEPT_BACKLOG)  # (conn, addr)
+        self.handler_threads = []
+        self.busy = 0  # handlers currently serving a connection
+        self.busy_lock = threading.Lock()
+
+        # selector mode: open connections, listening socket registered
+        self.MAX_CONNECTIONS = MAX_CONNECTIONS
+        self.connections = 0
+        self.accepting = True
+        self.accept_resume = 0.0  # monotonic time accepting may resume
+
+        # read deadlines of all the connections, checked every TICK
+        self.deadlines = TimerWheel(TICK=0.25)
+        self.watchdog_thread = None
+
+        # scraped from this (the latest) server
+        REGISTRY.gauge(
+            "esplserver_accept_queue_depth",
+            "accepted connections waiting for a handler",
+            fn=self.pending.qsize,
+        )
+        REGISTRY.gauge(
+            "esplserver_handlers_busy",
+            "handlers serving a connection",
+            fn=lambda: self.busy,
+        )
+
+        # udp listener
+        self.udp_server = None
+        self.udp_reader = None
+        self.udp_thread = None
+        self.udp_recent = collections.OrderedDict()  # (addr, datagram) -> arrival
+        self.udp_datagrams = 0
+        self.udp_malformed = 0
+        self.udp_duplicates = 0
+        if UDP_PORT is not None:
+            self.udp_server = self.initialize_udp_server()
+
+        self.metrics_server = None
+        if METRICS_PORT is not None:
+            self.metrics_server = start_metrics_server(METRICS_PORT)
+
+        self.maintenance = None
+        if MAINTENANCE is not None:
+            self.maintenance = Maintenance(SAVE_DIR, **MAINTENANCE).start()
+
+    @property
+    def udp_stats(self):
+        return {
+            "datagrams": self.udp_datagrams,
+            "malformed": self.udp_malformed,
+            "duplicates": self.udp_duplicates,
+        }
 
     def initialize_server(self):
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.REUSE_PORT:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server.bind((self.IP_ADDR, self.PORT))
+        self.PORT = server.getsockname()[1]  # the actual port if PORT was 0
         return server
 
+    def initialize_udp_server(self):
+        udp_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.REUSE_PORT:
+            udp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        udp_server.bind((self.IP_ADDR, self.UDP_PORT))
+        self.UDP_PORT = udp_server.getsockname()[1]
+        self.udp_reader = FrameReader(self.HEADER, BUFFER_SIZE=65536)
+        return udp_server
+
     def start_logging_thread(self):
         thread = threading.Thread(target=self.LOGGER.write_msg_cache_to_file)
         thread.start()
@@ -44,43 +253,482 @@ class ESPLServer:
         """
 
         # start the server
-        self.server.listen()
-        print(f"[LISTENING] Server is listening on {self.IP_ADDR}: {self.PORT}")
+        self.server.listen(self.ACCEPT_BACKLOG)
+        log.info("[LISTENING] Server is listening on %s: %s", self.IP_ADDR, self.PORT)
+        if self.udp_server is not None:
+            log.info("[LISTENING] UDP on %s: %s", self.IP_ADDR, self.UDP_PORT)
+        if self.MODE == "selector":
+            self.run_selector_loop()
+            return
+
+        if self.udp_server is not None:
+            self.udp_thread = threading.Thread(target=self.run_udp_loop)
+            self.udp_thread.start()
+        self.watchdog_thread = threading.Thread(target=self.run_watchdog)
+        self.watchdog_thread.start()
+
         while self.running:
-            print(f"[ACTIVE CONNECTIONS] {threading.activeCount() - 1}", flush=True)
-            conn, addr = self.server.accept()
-            thread = threading.Thread(target=self.handle_client, args=(conn, addr))
+            try:
+                conn, addr = self.server.accept()
+            except OSError as e:
+                if not self.running:
+                    break  # socket closed by stop()
+                # e.g. out of file descriptors: the pending connection stays
+                # in the kernel queue, try again once some have closed
+                ACCEPT_ERRORS.inc()
+                log.warning("accept failed, backing off: %s", e)
+                time.sleep(ACCEPT_BACKOFF)
+                continue
+            if not self.running:
+                conn.close()  # the wake up connection from stop()
+                break
+            CONNECTIONS_ACCEPTED.inc()
+            CONNECTIONS_ACTIVE.inc()
+            log.debug("[ACTIVE CONNECTIONS] %s", CONNECTIONS_ACTIVE.value)
+            # the clock runs while the connection waits for a handler
+            self.deadlines.set(
+                conn, time.monotonic() + self.FIRST_BYTE_TIMEOUT, "first byte"
+            )
+            self.enqueue_client(conn, addr)
+
+    def enqueue_client(self, conn, addr):
+        """
+        hand an accepted connection to the pool
+        "wait" blocks the accept loop while the backlog is full
+        """
+        # grow the pool on demand, up to MAX_CLIENTS handlers
+        idle = len(self.handler_threads) - self.busy - self.pending.qsize()
+        if idle <= 0 and len(self.handler_threads) < self.MAX_CLIENTS:
+            thread = threading.Thread(target=self.run_handler)
             thread.start()
-            self.client_threads.append(thread)
+            self.handler_threads.append(thread)
+
+        while self.running:
+            try:
+                if self.SATURATION_POLICY == "shed":
+                    self.pending.put_nowait((conn, addr))
+                else:
+                    self.pending.put((conn, addr), timeout=0.5)
+                return
+            except queue.Full:
+                if self.SATURATION_POLICY == "shed":
+                    break
+        self.shed_client(conn, addr)
+
+    def shed_client(self, conn, addr):
+        self.deadlines.remove(conn)
+        CONNECTIONS_SHED.inc()
+        CONNECTIONS_ACTIVE.dec()
+        log.info("[%s] server saturated, connection shed", addr)
+        conn.close()
+
+    def run_handler(self):
+        """
+        pool thread: serve queued connections one at a time until stop()
+        """
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            with self.busy_lock:
+                self.busy += 1
+            try:
+                self.handle_client(*item)
+            finally:
+                with self.busy_lock:
+                    self.busy -= 1
 
     def handle_client(self, conn, addr):
         """
         funnction to handle each client connection
+        keeps reading frames until the client closes or goes idle
+        """
+        log.debug("[NEW CONNECTION] %s connected.", addr)
+        reader = FrameReader(self.HEADER)
+        frames = 0  # frames completed since the deadline was last armed
+        seq = None  # last message logged from this connection
+        wait_durable = self.LOGGER.DURABILITY == "batch"
+        try:
+            while self.running:
+                frame = reader.next_frame()
+                if frame is None:
+                    if wait_durable and seq is not None:
+                        # group commit: one fsync acknowledges every waiting
+                        # handler. bounded, the deadlines can't interrupt it
+                        self.LOGGER.wait_durable(seq, self.IDLE_TIMEOUT)
+                        seq = None
+                    # the watchdog shuts the socket down when a deadline passes
+                    self.arm_deadline(conn, reader, frames)
+                    frames = 0
+                    n = reader.recv_into(conn)
+                    if n == 0:
+                        break  # client closed the connection
+                    BYTES_RECEIVED.inc(n)
+                    continue
+                seq = self.handle_frame(conn, addr, reader, *frame) or seq
+                frames += 1
+        except (ValueError, struct.error) as e:
+            PARSE_ERRORS.inc()
+            log.warning("[%s] %s", addr, e)
+        except OSError:
+            pass
+
+        self.deadlines.remove(conn)
+        conn.close()
+        CONNECTIONS_ACTIVE.dec()
+        log.debug("[%s] Connection Closed", addr)
+
+    def arm_deadline(self, conn, reader, frames):
+        """
+        called before every read: the idle deadline runs between frames, the
+        frame deadline from the first byte of a frame, bytes trickling in
+        slowly do not extend it
+        frames -> number of frames completed since the last call
+        """
+        now = time.monotonic()
+        reason = self.deadlines.reason(conn)
+        if reader.unread():
+            if frames or reason != "frame":
+                self.deadlines.set(conn, now + self.FRAME_TIMEOUT, "frame")
+        elif frames or reason != "first byte":
+            self.deadlines.set(conn, now + self.IDLE_TIMEOUT, "idle")
+
+    def expire_deadlines(self):
+        """
+        returns [(conn, reason), ...] of the connections past their deadline
+        """
+        expired = self.deadlines.expire(time.monotonic())
+        for conn, reason in expired:
+            TIMEOUTS[reason].inc()
+            try:
+                addr = conn.getpeername()
+            except OSError:
+                addr = None
+            log.info("[%s] %s timeout", addr, reason)
+        return expired
+
+    def run_watchdog(self):
+        """
+        thread mode: drop the connections which missed a deadline
+        shutdown() wakes the handler blocked in recv, which closes the socket
+        """
+        while self.running:
+            time.sleep(self.deadlines.TICK)
+            for conn, _ in self.expire_deadlines():
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass  # the handler closed it meanwhile
+
+    def handle_frame(self, conn, addr, reader, frame_type, payload):
+        """
+        log the payload (a memoryview of the reader's buffer) of one frame
+        returns the sequence number of the last message logged, if any
         """
-        print(f"[NEW CONNECTION] {addr} connected.")
-        msg_length = conn.recv(self.HEADER).decode(self.FORMAT)
-        if msg_length:
-            msg_length = int(msg_length)
-            msg = conn.recv(msg_length).decode(self.FORMAT)
-            print(f"[{addr}] {msg}")
-            self.LOGGER.log(msg)
+        FRAMES_RECEIVED.inc()
+        if frame_type == TEXT:
+            if not payload:
+                return
+            msg = str(payload, self.FORMAT)
+            log.debug("[%s] %s", addr, msg)
+            readings = self.parse_text_batch(addr, msg)
+            if readings:
+                return self.LOGGER.log_readings(readings)
+        elif frame_type == READING:
+            sensor_id, ts, value = READING_RECORD.unpack(payload)
+            log.debug("[%s] %s,%s", addr, sensor_id, value)
+            return self.LOGGER.log_reading(sensor_id, from_float32(value), ts or None)
+        elif frame_type == BATCH:
+            readings = [
+                Reading(
+                    sensor_id, from_float32(value), ts * 1_000_000_000 if ts else None
+                )
+                for sensor_id, ts, value in READING_RECORD.iter_unpack(payload)
+            ]
+            log.debug("[%s] batch of %s readings", addr, len(readings))
+            return self.LOGGER.log_readings(readings)
+        elif frame_type == HELLO:
+            # nothing to negotiate over udp, every datagram carries its version
+            if conn is not None:
+                conn.sendall(encode_hello(reader.version))
+                log.debug("[%s] binary protocol version %s", addr, reader.version)
+        else:
+            raise ValueError(f"unknown frame type: {frame_type}")
 
+    @staticmethod
+    def parse_text_batch(addr, msg):
+        """
+        "ID,value[,unix time];..." -> [Reading, ...]
+        malformed readings are counted and skipped, the rest are kept
+        """
+        readings = []
+        for text in msg.split(";"):
+            if not text:
+                continue
+            try:
+                readings.append(parse_reading(text))
+            except ValueError as e:
+                PARSE_ERRORS.inc()
+                log.warning("[%s] %s", addr, e)
+        return readings
+
+    def run_udp_loop(self):
+        """
+        thread mode: receive datagrams until the server stops
+        """
+        self.udp_server.settimeout(0.5)
+        while self.running:
+            try:
+                self.service_udp()
+            except socket.timeout:
+                continue
+            except OSError:
+                break  # socket closed by stop()
+
+    def service_udp(self):
+        """
+        receive one datagram and log its frames
+        a datagram holds one or more complete frames, in either wire format
+        """
+        reader = self.udp_reader
+        n, addr = reader.recv_datagram(self.udp_server)
+        self.udp_datagrams += 1
+        UDP_DATAGRAMS.inc()
+        BYTES_RECEIVED.inc(n)
+        datagram = bytes(reader.view[:n])
+
+        try:
+            frames = []  # payloads copied, the reader's buffer is reused
+            while True:
+                frame = reader.next_frame()
+                if frame is None:
+                    break
+                frames.append((frame[0], bytes(frame[1])))
+            if reader.unread():
+                raise ValueError(f"truncated datagram, {reader.unread()} bytes left")
+            # a resent datagram can only be told from a repeated reading by
+            # its device times, datagrams without them are never dropped
+            if all(self.has_device_time(*frame) for frame in frames):
+                if self.is_duplicate_datagram(addr, datagram):
+                    self.udp_duplicates += 1
+                    UDP_DUPLICATES.inc()
+                    return
+            for frame in frames:
+                self.handle_frame(None, addr, reader, *frame)
+        except (ValueError, struct.error) as e:
+            self.udp_malformed += 1
+            PARSE_ERRORS.inc()
+            log.warning("[%s] malformed datagram: %s", addr, e)
+
+    @staticmethod
+    def has_device_time(frame_type, payload):
+        """
+        True if every reading of the frame carries the time it was taken
+        """
+        if frame_type == TEXT:
+            readings = [text for text in payload.split(b";") if text]
+            return bool(readings) and all(text.count(b",") == 2 for text in readings)
+        if frame_type in (READING, BATCH):
+            return bool(payload) and all(
+                ts for _, ts, _ in READING_RECORD.iter_unpack(payload)
+            )
+        return False
+
+    def is_duplicate_datagram(self, addr, datagram):
+        """
+        remembers the datagrams of the last UDP_DEDUP_WINDOW seconds
+        """
+        now = time.monotonic()
+        recent = self.udp_recent
+        while recent:
+            key, arrival = next(iter(recent.items()))
+            if now - arrival <= self.UDP_DEDUP_WINDOW:
+                break
+            del recent[key]
+
+        key = (addr, datagram)
+        if key in recent:
+            return True
+        recent[key] = now
+        return False
+
+    def run_selector_loop(self):
+        """
+        serve all the connections from a single thread using selectors
+        """
+        sel = selectors.DefaultSelector()
+        self.server.setblocking(False)
+        sel.register(self.server, selectors.EVENT_READ, data=None)
+        if self.udp_server is not None:
+            self.udp_server.setblocking(False)
+            sel.register(self.udp_server, selectors.EVENT_READ, data="udp")
+
+        while self.running:
+            for key, _ in sel.select(timeout=self.deadlines.TICK):
+                if key.data is None:
+                    self.accept_client(sel)
+                elif key.data == "udp":
+                    try:
+                        self.service_udp()
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                else:
+                    self.service_client(sel, key.fileobj, key.data)
+            for conn, _ in self.expire_deadlines():
+                self.close_client(sel, conn, sel.get_key(conn).data)
+            self.resume_accepting(sel)
+
+        # close whatever is still connected
+        for key in list(sel.get_map().values()):
+            if isinstance(key.data, dict):
+                self.close_client(sel, key.fileobj, key.data)
+        sel.close()
+
+    def accept_client(self, sel):
+        """
+        accept a new connection and register it with the selector
+        """
+        try:
+            conn, addr = self.server.accept()
+        except (BlockingIOError, InterruptedError, ConnectionAbortedError):
+            return
+        except OSError as e:
+            # e.g. out of file descriptors, the listening socket would stay
+            # readable and spin the loop
+            ACCEPT_ERRORS.inc()
+            log.warning("accept failed, backing off: %s", e)
+            self.pause_accepting(sel, ACCEPT_BACKOFF)
+            return
+        CONNECTIONS_ACCEPTED.inc()
+        CONNECTIONS_ACTIVE.inc()
+        if self.connections >= self.MAX_CONNECTIONS:
+            self.shed_client(conn, addr)
+            return
+        log.debug("[NEW CONNECTION] %s connected.", addr)
+        conn.setblocking(False)
+        # per connection state: address, frame reader, last activity
+        state = {
+            "addr": addr,
+            "reader": FrameReader(self.HEADER),
+        }
+        sel.register(conn, selectors.EVENT_READ, data=state)
+        self.deadlines.set(
+            conn, time.monotonic() + self.FIRST_BYTE_TIMEOUT, "first byte"
+        )
+        self.connections += 1
+        if (
+            self.connections >= self.MAX_CONNECTIONS
+            and self.SATURATION_POLICY == "wait"
+        ):
+            # leave new connections in the kernel backlog until one closes
+            self.pause_accepting(sel)
+
+    def pause_accepting(self, sel, backoff=0.0):
+        """
+        selector mode: stop watching the listening socket for backoff seconds,
+        and until the connections are below MAX_CONNECTIONS again
+        """
+        if self.accepting:
+            sel.unregister(self.server)
+            self.accepting = False
+        self.accept_resume = time.monotonic() + backoff
+
+    def resume_accepting(self, sel):
+        if (
+            self.accepting
+            or not self.running
+            or self.connections >= self.MAX_CONNECTIONS
+            or time.monotonic() < self.accept_resume
+        ):
+            return
+        sel.register(self.server, selectors.EVENT_READ, data=None)
+        self.accepting = True
+
+    def service_client(self, sel, conn, state):
+        """
+        read available bytes and log every complete frame in the buffer
+        """
+        reader = state["reader"]
+        try:
+            n = reader.recv_into(conn)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            n = 0
+
+        if n == 0:
+            # client closed the connection
+            self.close_client(sel, conn, state)
+            return
+
+        BYTES_RECEIVED.inc(n)
+        frames = 0
+        try:
+            while True:
+                frame = reader.next_frame()
+                if frame is None:
+                    break
+                self.handle_frame(conn, state["addr"], reader, *frame)
+                frames += 1
+        except (ValueError, struct.error) as e:
+            PARSE_ERRORS.inc()
+            log.warning("[%s] %s", state["addr"], e)
+            self.close_client(sel, conn, state)
+            return
+        self.arm_deadline(conn, reader, frames)
+
+    def close_client(self, sel, conn, state):
+        self.deadlines.remove(conn)
+        sel.unregister(conn)
         conn.close()
-        print(f"[{addr}] Connection Closed")
+        CONNECTIONS_ACTIVE.dec()
+        log.debug("[%s] Connection Closed", state["addr"])
+        self.connections -= 1
+        self.resume_accepting(sel)
 
     def stop(self):
         """
         stops the server, logging threads
         """
-        # close all the client threads
-        for thread in self.client_threads:
-            thread.join()
-
         # get out of the while loop
         # create a fake connection, to get out of the while loop
         self.running = False
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((self.IP_ADDR, self.PORT))
+        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect(
+            (self.IP_ADDR, self.PORT)
+        )
         self.server.close()
+
+        # close the connections nobody picked up, then the handler pool
+        while True:
+            try:
+                conn, addr = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            self.deadlines.remove(conn)
+            conn.close()
+            CONNECTIONS_ACTIVE.dec()
+        # wake the handlers blocked in recv first: the sentinels go through the
+        # bounded backlog, so they only all fit once the handlers take them
+        for conn in self.deadlines.keys():
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for _ in self.handler_threads:
+            self.pending.put(None)
+        for thread in self.handler_threads:
+            thread.join()
+        if self.watchdog_thread is not None:
+            self.watchdog_thread.join()
+        if self.udp_server is not None:
+            self.udp_server.close()
+            if self.udp_thread is not None:
+                self.udp_thread.join()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        if self.maintenance is not None:
+            self.maintenance.stop()
         self.LOGGER.stop()
-        print("SERVER stopped...")
+        log.info("SERVER stopped...")
         time.sleep(0.1)  # give the threads some time to close
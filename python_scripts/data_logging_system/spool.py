@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""write-ahead spool for the DataLogger queue"""
+
+import os
+import glob
+import zlib
+import struct
+import threading
+from console_log import get_log
+from readings import NAME_BASE, Reading, intern_sensor_id, sensor_name
+
+log = get_log("spool")
+
+# spool record: crc32 of the rest, seq, unix time in ns, value, sensor id,
+# length of the utf-8 sensor name (0 for numeric ids) followed by the name
+RECORD_HEADER = struct.Struct("<IQqdQI")
+CHECKPOINT_FILE = "checkpoint"
+
+
+def encode_record(reading):
+    sensor_id = reading.sensor_id
+    name = sensor_name(sensor_id).encode("utf-8") if sensor_id >= NAME_BASE else b""
+    body = (
+        RECORD_HEADER.pack(
+            0, reading.seq, reading.ts_ns, reading.value, sensor_id, len(name)
+        )[4:]
+        + name
+    )
+    return struct.pack("<I", zlib.crc32(body)) + body
+
+
+def scan_segment(path):
+    """
+    returns the Readings of a segment file
+    a recycled segment still holds older records after the newest ones, the
+    scan stops at the first record which is torn (bad crc) or not newer
+    than the one before
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    records = []
+    pos = 0
+    last_seq = 0
+    dropped = 0
+    while pos + RECORD_HEADER.size <= len(data):
+        crc, seq, ts_ns, value, sensor_id, length = RECORD_HEADER.unpack_from(data, pos)
+        end = pos + RECORD_HEADER.size + length
+        if end > len(data) or zlib.crc32(data[pos + 4 : end]) != crc:
+            break
+        if seq <= last_seq:
+            break
+        if length:
+            # interned ids are per process, the name is what survives a restart
+            name = str(data[pos + RECORD_HEADER.size : end], "utf-8")
+            try:
+                sensor_id = intern_sensor_id(name)
+            except ValueError:
+                sensor_id = None
+        if sensor_id is None:
+            dropped += 1
+        else:
+            records.append(Reading(sensor_id, value, ts_ns, seq))
+        last_seq = seq
+        pos = end
+    if dropped:
+        log.warning("%s records skipped, sensor name table full:: %s", dropped, path)
+    return records
+
+
+class Segment:
+    """
+    one spool file, written from the start with os.write
+    """
+
+    def __init__(self, path, first_seq=0, last_seq=0):
+        self.path = path
+        self.first_seq = first_seq
+        self.last_seq = last_seq
+        self.fd = None
+        self.size = 0
+
+    def open(self):
+        # no O_TRUNC: recycling overwrites in place, no metadata churn
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+        self.size = 0
+        self.first_seq = self.last_seq = 0
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class Spool:
+    """
+    append-only log of the records queued in a DataLogger
+
+    the logger appends every record before queueing it (one os.write per
+    batch, so a crashed process loses nothing the kernel has) and the writer
+    thread checkpoints the highest seq which reached the daily store.
+    segments holding only checkpointed records are reused for new records,
+    so in steady state the spool costs one sequential append per batch.
+    on startup the records after the checkpoint are replayed; a record which
+    was written but not yet checkpointed when the process died is logged
+    twice (at least once delivery)
+    """
+
+    def __init__(self, DIR, SEGMENT_SIZE=4 << 20, KEEP_FREE=2, SYNC=False):
+        """
+        DIR -> directory of the segment files and the checkpoint
+        SEGMENT_SIZE -> bytes per segment before moving on to the next one
+        KEEP_FREE -> checkpointed segments kept for reuse, the rest are deleted
+        SYNC -> fsync the checkpoint file
+        """
+        self.DIR = DIR
+        self.SEGMENT_SIZE = SEGMENT_SIZE
+        self.KEEP_FREE = KEEP_FREE
+        self.SYNC = SYNC
+        os.makedirs(DIR, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.checkpoint_seq = self.read_checkpoint()
+        self.segments = []  # segments holding records after the checkpoint
+        self.free = []  # checkpointed segments, ready for reuse
+        self.current = None
+        self.next_index = 0
+        self.last_seq = self.checkpoint_seq
+        self.recover()
+
+    def read_checkpoint(self):
+        try:
+            with open(os.path.join(self.DIR, CHECKPOINT_FILE)) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def recover(self):
+        """
+        scan the segments left by the previous run
+        """
+        for path in sorted(glob.glob(os.path.join(self.DIR, "*.seg"))):
+            index = int(os.path.basename(path).split(".")[0])
+            self.next_index = max(self.next_index, index + 1)
+            records = scan_segment(path)
+            segment = Segment(path)
+            if records:
+                segment.first_seq, segment.last_seq = records[0].seq, records[-1].seq
+                self.last_seq = max(self.last_seq, segment.last_seq)
+            if segment.last_seq > self.checkpoint_seq:
+                self.segments.append(segment)
+            elif len(self.free) < self.KEEP_FREE:
+                self.free.append(segment)
+            else:
+                os.remove(path)
+        self.segments.sort(key=lambda segment: segment.first_seq)
+        self.replay_segments = list(self.segments)
+        self.replay_upto = self.last_seq
+        if self.segments:
+            log.info(
+                "records %s to %s to replay from %s",
+                self.checkpoint_seq + 1,
+                self.last_seq,
+                self.DIR,
+            )
+
+    def replay(self):
+        """
+        yields the Readings after the checkpoint, oldest first
+        """
+        after = self.checkpoint_seq
+        for segment in self.replay_segments:
+            for reading in scan_segment(segment.path):
+                if after < reading.seq <= self.replay_upto:
+                    yield reading
+        self.replay_segments = []
+
+    def new_segment(self):
+        """
+        next segment to write, a recycled one if there is any
+        """
+        if self.free:
+            segment = self.free.pop()
+        else:
+            path = os.path.join(self.DIR, f"{self.next_index:08}.seg")
+            self.next_index += 1
+            segment = Segment(path)
+        segment.open()
+        self.segments.append(segment)
+        return segment
+
+    def append(self, records):
+        """
+        write the Readings, seqs have to be increasing
+        """
+        data = b"".join(encode_record(reading) for reading in records)
+        with self.lock:
+            segment = self.current
+            if segment is None or (
+                segment.size and segment.size + len(data) > self.SEGMENT_SIZE
+            ):
+                if segment is not None:
+                    segment.close()
+                segment = self.current = self.new_segment()
+            os.write(segment.fd, data)
+            segment.size += len(data)
+            if not segment.first_seq:
+                segment.first_seq = records[0].seq
+            segment.last_seq = records[-1].seq
+            self.last_seq = segment.last_seq
+
+    def checkpoint(self, seq):
+        """
+        records up to seq are in the daily store: note it and free their segments
+        """
+        path = os.path.join(self.DIR, CHECKPOINT_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write(str(seq))
+            if self.SYNC:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        with self.lock:
+            self.checkpoint_seq = seq
+            for segment in list(self.segments):
+                if segment is self.current or segment.last_seq > seq:
+                    continue
+                self.segments.remove(segment)
+                if len(self.free) < self.KEEP_FREE:
+                    self.free.append(segment)
+                else:
+                    os.remove(segment.path)
+
+    def close(self):
+        with self.lock:
+            if self.current is not None:
+                self.current.close()
+                self.current = None
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""storage backends for the DataLogger"""
+
+import os
+import time
+import logging
+import struct
+from metrics import REGISTRY
+from console_log import get_log
+from paths import DateCache, get_DD_filepath, get_MMYY_directory_path
+from archive import open_log
+from readings import sensor_name, sensor_number, format_value
+
+# binary record: unix time, sensor id, value
+RECORD_FORMAT = "<dIf"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+# same layout as a numpy dtype, for readers using np.fromfile / np.memmap
+RECORD_DTYPE = [("time", "<f8"), ("id", "<u4"), ("value", "<f4")]
+
+log = get_log("storage")
+
+FLUSH_LATENCY = REGISTRY.histogram(
+    "storage_flush_seconds", "time to flush the log file"
+)
+FSYNC_LATENCY = REGISTRY.histogram(
+    "storage_fsync_seconds", "time to fsync the log file"
+)
+
+
+def get_shard_ext(shard, ext):
+    """
+    (2, ".csv") -> ".shard2.csv"
+    """
+    return f".shard{shard}{ext}"
+
+
+class Storage:
+    """
+    base class for the storage backends
+    keeps the current day's file open, reopens it when the date rolls over
+    and flushes every FLUSH_SIZE records or FLUSH_INTERVAL seconds
+    records go to the file of the day they were logged, not written
+
+    subclasses define EXT, MODE, HEADER and encode()
+    with SHARD set the files are named DD.shard<SHARD><EXT>, so that several
+    processes can log the same day (see workers.py)
+    with FSYNC set, new files and their directory entries are fsynced, and so
+    is a day's file when it is closed; the logger calls sync() for the rest
+    """
+
+    EXT = None
+    MODE = "a"
+    HEADER = None
+
+    def __init__(
+        self, BASE_DIR, FLUSH_SIZE=100, FLUSH_INTERVAL=1.0, SHARD=None, FSYNC=False
+    ):
+        self.BASE_DIR = BASE_DIR
+        self.FLUSH_SIZE = FLUSH_SIZE
+        self.FLUSH_INTERVAL = FLUSH_INTERVAL
+        self.SHARD = SHARD
+        self.FSYNC = FSYNC
+        self.ext = self.EXT if SHARD is None else get_shard_ext(SHARD, self.EXT)
+
+        self.dates = DateCache()
+        self.file = None
+        self.file_path = None
+        self.file_date = None
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def initialize_DDMMYY_logfile(self, date):
+        """
+        creates the log dir and initializes the logfile of date
+        """
+
+        # create MMYY directory if needed
+        dir_path = get_MMYY_directory_path(self.BASE_DIR, date)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+
+        # initialize the file (header) if needed
+        file_path = get_DD_filepath(self.BASE_DIR, self.ext, date)
+        if not os.path.exists(file_path):
+            with open(file_path, "w") as f:
+                if self.HEADER is not None:
+                    f.write(self.HEADER + "\n")
+                if self.FSYNC:
+                    f.flush()
+                    os.fsync(f.fileno())
+            if self.FSYNC:
+                # make the new file's name durable too
+                fd = os.open(dir_path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        return file_path
+
+    def get_file(self, date):
+        """
+        returns the open file of date, only reopens when the date changes
+        """
+        if self.file_date != date:
+            self.close()
+            self.file_path = self.initialize_DDMMYY_logfile(date)
+            self.file = open(self.file_path, self.MODE)
+            self.file_date = date
+        return self.file
+
+    def encode(self, records):
+        """
+        returns the list of chunks to write for the Readings
+        """
+        raise NotImplementedError
+
+    def write(self, records):
+        """
+        write a batch of Readings, one writelines per day in the batch
+        """
+        start = 0
+        while start < len(records):
+            # split the batch into runs of records from the same day
+            # (device timestamps may go back to an earlier day)
+            date = self.dates.get_date(records[start].ts)
+            day_start = int(self.dates.day_start * 1e9)
+            next_midnight = int(self.dates.next_midnight * 1e9)
+            end = start + 1
+            while (
+                end < len(records) and day_start <= records[end].ts_ns < next_midnight
+            ):
+                end += 1
+
+            f = self.get_file(date)
+            f.writelines(self.encode(records[start:end]))
+            if log.isEnabledFor(logging.DEBUG):
+                for reading in records[start:end]:
+                    log.debug("logged msg:: %s to file %s", reading, self.file_path)
+            start = end
+
+        self.unflushed += len(records)
+        if (
+            self.unflushed >= self.FLUSH_SIZE
+            or time.monotonic() - self.last_flush >= self.FLUSH_INTERVAL
+        ):
+            self.flush()
+
+    def flush(self):
+        if self.file is not None and self.unflushed > 0:
+            start = time.perf_counter()
+            self.file.flush()
+            FLUSH_LATENCY.observe(time.perf_counter() - start)
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def sync(self):
+        """
+        flush and fsync the open file, the records written so far survive a crash
+        """
+        if self.file is not None:
+            self.flush()
+            start = time.perf_counter()
+            os.fsync(self.file.fileno())
+            FSYNC_LATENCY.observe(time.perf_counter() - start)
+
+    def close(self):
+        if self.file is not None:
+            if self.FSYNC:
+                self.sync()
+            else:
+                self.flush()
+            self.file.close()
+        self.file = None
+        self.file_path = None
+        self.file_date = None
+
+
+class CSVStorage(Storage):
+    """
+    YYYY/MM/DD.csv text files
+    """
+
+    EXT = ".csv"
+    MODE = "a"
+    HEADER = "TIME,ID,TEMP"
+
+    def encode(self, records):
+        # the only place a reading turns into text
+        get_time_str = self.dates.get_time_str
+        return [
+            f"{get_time_str(reading.ts_ns // 1_000_000_000)},"
+            f"{sensor_name(reading.sensor_id)},{format_value(reading.value)}\n"
+            for reading in records
+        ]
+
+
+class BinaryStorage(Storage):
+    """
+    YYYY/MM/DD.bin files of fixed width little endian records (RECORD_FORMAT)
+    sensors with non numeric names (see readings.intern_sensor_id) are skipped,
+    all digit names are stored as their number ("0007" -> 7)
+    """
+
+    EXT = ".bin"
+    MODE = "ab"
+    HEADER = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.skipped = 0
+
+    def encode(self, records):
+        pack = struct.Struct(RECORD_FORMAT).pack
+        chunks = []
+        for reading in records:
+            sensor_id = sensor_number(reading.sensor_id)
+            if sensor_id is None:
+                self.skipped += 1
+                log.warning("skipped non numeric record:: %s", reading)
+                continue
+            chunks.append(pack(reading.ts, sensor_id, reading.value))
+        return chunks
+
+
+STORAGE_BACKENDS = {
+    "csv": CSVStorage,
+    "binary": BinaryStorage,
+}
+
+
+def read_binary_records(path, CHUNK=4096):
+    """
+    yields (time, id, value) tuples from a .bin log file, streamed CHUNK
+    records at a time; compressed and archived days are read transparently
+    """
+    with open_log(path) as f:
+        while True:
+            data = f.read(CHUNK * RECORD_SIZE)
+            # ignore a partially written trailing record
+            data = data[: len(data) - len(data) % RECORD_SIZE]
+            if not data:
+                break
+            yield from struct.iter_unpack(RECORD_FORMAT, data)
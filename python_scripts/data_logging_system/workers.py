@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""multi process ingestion: N ESPLServer workers sharing the port with SO_REUSEPORT
+
+every worker logs to its own shard of the day (DD.shard<N>.csv / .bin),
+merge_day() combines the shards into the ordered DD.csv / DD.bin
+(reader.py also merges the shards when reading)
+
+a day file is written in arrival order, which is not time order once the
+devices send their own times (late or clock skewed readings), so merge_day()
+and reader.py sort by time instead of merging sorted runs
+"""
+
+import os
+import glob
+import time
+import struct
+import socket
+import signal
+import logging
+import argparse
+import datetime
+import threading
+import multiprocessing
+import multiprocessing.connection
+from server import ESPLServer
+from storage import CSVStorage, RECORD_FORMAT, read_binary_records, get_shard_ext
+from paths import get_DD_filepath
+from archive import Maintenance
+from console_log import get_log, setup_console_log
+
+log = get_log("workers")
+
+
+def run_worker(shard, IP_ADDR, PORT, SAVE_DIR, server_kwargs, log_kwargs):
+    """
+    worker process: one selector mode server + logger, until SIGTERM / SIGINT
+    with METRICS_PORT set, worker N serves its metrics on METRICS_PORT + N
+    with SPOOL_DIR set, worker N spools to SPOOL_DIR/shard<N>
+    """
+    # the console thread of the parent does not survive the fork
+    setup_console_log(**log_kwargs)
+    server_kwargs = dict(server_kwargs)
+    if server_kwargs.get("METRICS_PORT") is not None:
+        server_kwargs["METRICS_PORT"] += shard
+    if server_kwargs.get("SPOOL_DIR") is not None:
+        # a restarted worker replays its own shard's spool
+        server_kwargs["SPOOL_DIR"] = os.path.join(
+            server_kwargs["SPOOL_DIR"], f"shard{shard}"
+        )
+    srv = ESPLServer(
+        IP_ADDR,
+        PORT,
+        SAVE_DIR,
+        MODE="selector",
+        REUSE_PORT=True,
+        SHARD=shard,
+        **server_kwargs,
+    )
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    server_thread = threading.Thread(target=srv.start_server, args=(None,))
+    logger_thread = threading.Thread(target=srv.LOGGER.write_msg_cache)
+    server_thread.start()
+    logger_thread.start()
+    log.info("[WORKER %s] pid %s started", shard, os.getpid())
+
+    while not stop.wait(0.5):
+        if not server_thread.is_alive() or not logger_thread.is_alive():
+            break  # let the supervisor restart us
+
+    srv.stop()
+    server_thread.join()
+    logger_thread.join()
+    log.info("[WORKER %s] stopped", shard)
+
+
+class WorkerSupervisor:
+    """
+    starts WORKERS processes and restarts the ones which die
+    """
+
+    def __init__(
+        self,
+        IP_ADDR,
+        PORT,
+        SAVE_DIR,
+        WORKERS=None,
+        RESTART_DELAY=1.0,
+        LOG_KWARGS=None,
+        MAINTENANCE=None,
+        **server_kwargs,
+    ):
+        """
+        IP_ADDR, PORT, SAVE_DIR -> as for ESPLServer
+        WORKERS -> number of processes (default: cpu count)
+        RESTART_DELAY -> min seconds between two starts of the same worker
+        LOG_KWARGS -> setup_console_log() arguments for the workers
+        MAINTENANCE -> archive.Maintenance arguments, run once in the
+                       supervisor rather than in every worker (None: off)
+        server_kwargs -> passed on to every worker's ESPLServer
+        """
+        self.IP_ADDR = IP_ADDR
+        self.SAVE_DIR = SAVE_DIR
+        self.WORKERS = WORKERS or os.cpu_count()
+        self.RESTART_DELAY = RESTART_DELAY
+        self.server_kwargs = server_kwargs
+        self.LOG_KWARGS = LOG_KWARGS or {}
+        self.MAINTENANCE = MAINTENANCE
+
+        # hold the port (bound, not listening: it never gets connections),
+        # this also resolves PORT=0 to a real port for all the workers
+        self.port_holder = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.port_holder.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.port_holder.bind((IP_ADDR, PORT))
+        self.PORT = self.port_holder.getsockname()[1]
+
+        self.workers = {}  # shard -> process
+        self.started = {}  # shard -> last start time
+        self.restarts = 0
+        self.running = True
+
+    def start_worker(self, shard):
+        proc = multiprocessing.Process(
+            target=run_worker,
+            args=(
+                shard,
+                self.IP_ADDR,
+                self.PORT,
+                self.SAVE_DIR,
+                self.server_kwargs,
+                self.LOG_KWARGS,
+            ),
+            name=f"esplserver-worker-{shard}",
+        )
+        proc.start()
+        self.workers[shard] = proc
+        self.started[shard] = time.monotonic()
+
+    def run(self):
+        """
+        start the workers and supervise them until stop()
+        """
+        for shard in range(self.WORKERS):
+            self.start_worker(shard)
+        maintenance = None
+        if self.MAINTENANCE is not None:
+            maintenance = Maintenance(self.SAVE_DIR, **self.MAINTENANCE).start()
+        log.info(
+            "[LISTENING] %s workers on %s: %s", self.WORKERS, self.IP_ADDR, self.PORT
+        )
+
+        while self.running:
+            sentinels = [proc.sentinel for proc in self.workers.values()]
+            multiprocessing.connection.wait(sentinels, timeout=0.5)
+            if not self.running:
+                break
+            for shard, proc in list(self.workers.items()):
+                if proc.is_alive():
+                    continue
+                if time.monotonic() - self.started[shard] < self.RESTART_DELAY:
+                    continue  # crash loop, try again a bit later
+                proc.join()
+                log.warning(
+                    "[WORKER %s] exited with %s, restarting", shard, proc.exitcode
+                )
+                self.restarts += 1
+                self.start_worker(shard)
+
+        for proc in self.workers.values():
+            if proc.is_alive():
+                proc.terminate()  # SIGTERM: the worker stops its server / logger
+        for proc in self.workers.values():
+            proc.join()
+        if maintenance is not None:
+            maintenance.stop()
+        self.port_holder.close()
+        log.info("SUPERVISOR stopped...")
+
+    def stop(self):
+        self.running = False
+
+
+def merge_day(base_dir, date, ext=".csv"):
+    """
+    merge the shards of a day (and an existing unsharded file) by time into
+    DD<ext>, then remove the shards. returns the number of records merged
+    """
+    day_path = get_DD_filepath(base_dir, ext, date)
+    shard_paths = sorted(
+        glob.glob(get_DD_filepath(base_dir, get_shard_ext("*", ext), date))
+    )
+    if not shard_paths:
+        return 0
+    sources = shard_paths + ([day_path] if os.path.exists(day_path) else [])
+
+    tmp_path = day_path + ".tmp"
+    count = 0
+    if ext == ".csv":
+        files = [open(path) for path in sources]
+        try:
+            # HH:MM:SS sorts as text, the stable sort keeps arrival order
+            # between readings of the same second
+            rows = [line for f in files for line in f if line[:1].isdigit()]
+            rows.sort(key=lambda line: line[:8])
+            with open(tmp_path, "w") as out:
+                out.write(CSVStorage.HEADER + "\n")
+                for line in rows:
+                    out.write(line if line.endswith("\n") else line + "\n")
+                    count += 1
+        finally:
+            for f in files:
+                f.close()
+    else:
+        pack = struct.Struct(RECORD_FORMAT).pack
+        records = [record for path in sources for record in read_binary_records(path)]
+        records.sort(key=lambda record: record[0])
+        with open(tmp_path, "wb") as out:
+            for record in records:
+                out.write(pack(*record))
+                count += 1
+
+    os.replace(tmp_path, day_path)
+    for path in shard_paths:
+        os.remove(path)
+        # sensor index left behind by reader.py
+        idx_path = os.path.splitext(path)[0] + ".idx.npz"
+        if os.path.exists(idx_path):
+            os.remove(idx_path)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="run the worker processes")
+    serve.add_argument("base_dir")
+    serve.add_argument("--ip", default="0.0.0.0")
+    serve.add_argument("--port", type=int, default=5050)
+    serve.add_argument("-w", "--workers", type=int, default=None)
+    serve.add_argument("--storage", choices=("csv", "binary"), default="csv")
+    serve.add_argument(
+        "--metrics-port", type=int, help="worker N uses metrics-port + N"
+    )
+    serve.add_argument(
+        "--durability", choices=("none", "interval", "batch"), default="none"
+    )
+    serve.add_argument(
+        "--fsync-interval", type=float, default=0.1, help="seconds, interval mode"
+    )
+    serve.add_argument(
+        "--spool", action="store_true", help="write-ahead spool in BASE_DIR/spool"
+    )
+    serve.add_argument(
+        "--compress-after", type=int, help="gzip days older than this many days"
+    )
+    serve.add_argument(
+        "--archive-after", type=int, help="zip months older than this many days"
+    )
+    serve.add_argument(
+        "--delete-after", type=int, help="delete days older than this many days"
+    )
+    serve.add_argument("-v", "--verbose", action="store_true", help="log every message")
+    serve.add_argument("--log-rate", type=float, help="max debug/info lines per second")
+
+    merge = commands.add_parser("merge", help="merge the shards of finished days")
+    merge.add_argument("base_dir")
+    merge.add_argument("--date", help="YYYY-MM-DD (default: yesterday)")
+    merge.add_argument("--storage", choices=("csv", "binary"), default="csv")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        log_kwargs = {
+            "LEVEL": logging.DEBUG if args.verbose else logging.INFO,
+            "RATE_LIMIT": args.log_rate,
+        }
+        setup_console_log(**log_kwargs)
+        maintenance = {
+            "COMPRESS_AFTER_DAYS": args.compress_after,
+            "ARCHIVE_AFTER_DAYS": args.archive_after,
+            "DELETE_AFTER_DAYS": args.delete_after,
+        }
+        if not any(value is not None for value in maintenance.values()):
+            maintenance = None
+        supervisor = WorkerSupervisor(
+            args.ip,
+            args.port,
+            args.base_dir,
+            args.workers,
+            LOG_KWARGS=log_kwargs,
+            MAINTENANCE=maintenance,
+            STORAGE=args.storage,
+            METRICS_PORT=args.metrics_port,
+            DURABILITY=args.durability,
+            FSYNC_INTERVAL=args.fsync_interval,
+            SPOOL_DIR=os.path.join(args.base_dir, "spool") if args.spool else None,
+        )
+        signal.signal(signal.SIGTERM, lambda *_: supervisor.stop())
+        signal.signal(signal.SIGINT, lambda *_: supervisor.stop())
+        supervisor.run()
+    else:
+        if args.date is None:
+            date = datetime.date.today() - datetime.timedelta(days=1)
+        else:
+            date = datetime.date.fromisoformat(args.date)
+        ext = ".csv" if args.storage == "csv" else ".bin"
+        count = merge_day(args.base_dir, date, ext)
+        print(
+            f"merged {count} records into {get_DD_filepath(args.base_dir, ext, date)}"
+        )
+
+
+if __name__ == "__main__":
+    main()